@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Batch filter-efficiency analysis over the rotated data files of one or more
+sensor boxes.
+
+Every data file is summarized on its own, in parallel across all cores: for
+each valve phase in the file, the count, sum and sum of squares of every
+numeric field, computed with vectorized NumPy. Summaries are cached by file
+path, size and modification time, so re-running a report only reads new or
+changed files. Phases cut in two by a file rotation are merged back together,
+then consecutive A and B phases are compared.
+
+python3 analysis.py /mnt/data/data.csv /mnt/box2/data.csv --field concent
+"""
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+
+import numpy as np
+
+import datareader
+from datafiles import open_data_file
+
+# Version of the summary format, bumped to invalidate old cache entries.
+CACHE_VERSION = 1
+
+
+def _phase_sums(phase_ids, count, values, keep):
+    """
+    Returns per-phase [count, sum, sum of squares] lists of the values that
+    are kept and not NaN.
+    """
+    ok = keep & ~np.isnan(values)
+    ids, vals = phase_ids[ok], values[ok]
+    n = np.bincount(ids, minlength=count)
+    s = np.bincount(ids, weights=vals, minlength=count)
+    ss = np.bincount(ids, weights=vals * vals, minlength=count)
+    return [[int(a), float(b), float(c)] for a, b, c in zip(n, s, ss)]
+
+
+def summarize_columns(columns, settle_time):
+    """
+    Summarize the valve phases in one set of columns.
+    columns : Dictionary of column name to NumPy array, as from
+              datareader.query, covering consecutive rows.
+    settle_time : float number of seconds at the start of each phase to
+                  leave out.
+    Returns a list of phase dictionaries with the valve state, start and end
+    times, and per-field [count, sum, sum of squares] of the settled rows.
+    The first phase also has the sums over all its rows in 'fields_all', for
+    when it continues a phase from the previous file.
+    """
+    valve = columns['valve']
+    rows = np.nonzero(np.isin(valve, ['a', 'b', 'both']))[0]
+    if len(rows) == 0:
+        return []
+    states = valve[rows]
+    times = columns['timestamp'][rows]
+    starts = np.concatenate(([True], states[1:] != states[:-1]))
+    phase_ids = np.cumsum(starts) - 1
+    start_rows = np.nonzero(starts)[0]
+    end_rows = np.concatenate((start_rows[1:] - 1, [len(rows) - 1]))
+    count = len(start_rows)
+    settled = times - times[start_rows][phase_ids] >= settle_time
+    everything = np.ones(len(rows), dtype=bool)
+
+    phases = [{
+        'valve': str(states[first]),
+        'start': float(times[first]),
+        'end': float(times[last]),
+        'fields': {},
+    } for first, last in zip(start_rows, end_rows)]
+    phases[0]['fields_all'] = {}
+    for name, column in columns.items():
+        if name in ('timestamp', 'valve') or column.dtype.kind not in 'fiu':
+            continue
+        values = column[rows].astype(float)
+        for phase, sums in zip(phases, _phase_sums(phase_ids, count, values, settled)):
+            phase['fields'][name] = sums
+        phases[0]['fields_all'][name] = _phase_sums(phase_ids, count, values, everything)[0]
+    return phases
+
+
+def summarize_file(path, header, settle_time):
+    """
+    Summarize one data file, see summarize_columns. Runs in a worker process.
+    header : Columns to assume if the file was rotated without a header line.
+    """
+    phases = []
+    for chunk in _column_groups(datareader.query([path], header=header, chunk_size=1 << 16)):
+        phases = _merge_phases(phases, summarize_columns(chunk, settle_time), max_gap=math.inf)
+    return phases
+
+
+def _column_groups(chunks):
+    """
+    Join consecutive chunks with the same columns.
+    """
+    group = []
+    for chunk in chunks:
+        if group and list(chunk.keys()) != list(group[0].keys()):
+            yield {name: np.concatenate([c[name] for c in group]) for name in group[0]}
+            group = []
+        group.append(chunk)
+    if group:
+        yield {name: np.concatenate([c[name] for c in group]) for name in group[0]}
+
+
+def _add_sums(a, b):
+    """
+    Returns the field sums of two parts of a phase combined.
+    """
+    result = dict(a)
+    for name, sums in b.items():
+        if name in result:
+            result[name] = [x + y for x, y in zip(result[name], sums)]
+        else:
+            result[name] = sums
+    return result
+
+
+def _merge_phases(phases, following, max_gap):
+    """
+    Append the phases following on from phases, joining the last and first
+    if they are the same valve state no more than max_gap seconds apart.
+    """
+    if not following:
+        return phases
+    if not phases:
+        return phases + following
+    last, first = phases[-1], following[0]
+    if last['valve'] != first['valve'] or first['start'] - last['end'] > max_gap:
+        return phases + following
+    # The first phase continues the last one, so none of it is settling.
+    merged = dict(last, end=first['end'], fields=_add_sums(last['fields'], first['fields_all']))
+    if 'fields_all' in last:
+        merged['fields_all'] = _add_sums(last['fields_all'], first['fields_all'])
+    return phases[:-1] + [merged] + following[1:]
+
+
+def _first_header(path):
+    """
+    Returns the columns of the header on the first line of a CSV file, or
+    None if it does not start with one.
+    """
+    if path.endswith('.rec'):
+        return None
+    with open_data_file(path) as f:
+        line = f.readline().decode('utf-8').rstrip('\r\n')
+    return line.split(',') if line.startswith('timestamp,') else None
+
+
+class SummaryCache(object):
+    """
+    File summaries stored as JSON, keyed by path and valid while the file's
+    size and modification time, and the settle time, are unchanged.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('version') == CACHE_VERSION:
+                self.entries = saved['entries']
+
+    @staticmethod
+    def _key(path, settle_time):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime, settle_time]
+
+    def get(self, path, settle_time):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is not None and entry['key'] == self._key(path, settle_time):
+            return entry['phases']
+        return None
+
+    def put(self, path, settle_time, phases):
+        self.entries[os.path.abspath(path)] = {'key': self._key(path, settle_time), 'phases': phases}
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'entries': self.entries}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def summarize_box(save_file, cache, settle_time, executor, max_gap=60):
+    """
+    Summarize every data file logged to save_file, reusing cached summaries.
+    Returns the box's phases in time order, with phases split across files
+    joined back together.
+    """
+    files = [path for path in datareader.data_files(save_file) if not path.endswith('.rec')]
+    # Files rotated without a header line use the last header before them.
+    headers, header = [], None
+    for path in files:
+        header = _first_header(path) or header
+        headers.append(header)
+    futures = {}
+    for path, header in zip(files, headers):
+        if cache.get(path, settle_time) is None:
+            futures[path] = executor.submit(summarize_file, path, header, settle_time)
+    for path, future in futures.items():
+        cache.put(path, settle_time, future.result())
+    phases = []
+    for path in files:
+        phases = _merge_phases(phases, cache.get(path, settle_time), max_gap)
+    return phases
+
+
+def _mean_std(sums):
+    n, s, ss = sums
+    if n == 0:
+        return None, None
+    mean = s / n
+    var = (ss - n * mean * mean) / (n - 1) if n > 1 else 0.0
+    return mean, math.sqrt(max(var, 0.0))
+
+
+def compare_phases(phases, field):
+    """
+    Compare each B phase with the A phase before it.
+    Returns a list of dictionaries with the phase times, A and B means of the
+    field and their ratio (B / A).
+    """
+    results = []
+    for before, after in zip(phases, phases[1:]):
+        if before['valve'] != 'a' or after['valve'] != 'b':
+            continue
+        mean_a, std_a = _mean_std(before['fields'].get(field, [0, 0, 0]))
+        mean_b, std_b = _mean_std(after['fields'].get(field, [0, 0, 0]))
+        ratio = mean_b / mean_a if mean_a and mean_b is not None else None
+        results.append({
+            'a_start': before['start'], 'b_end': after['end'],
+            'a_mean': mean_a, 'a_std': std_a, 'b_mean': mean_b, 'b_std': std_b,
+            'ratio': ratio,
+        })
+    return results
+
+
+def main():
+    """
+    Summarize the given boxes and print the A/B comparison of a field.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_files', nargs='+', help='The SAVE_FILE of each box.')
+    parser.add_argument('--field', default='concent', help='Field to compare between A and B.')
+    parser.add_argument('--settle', type=float, default=10,
+                        help='Seconds at the start of each phase to leave out.')
+    parser.add_argument('--cache', default='analysis-cache.json', help='Summary cache file.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to one per core.')
+    parser.add_argument('--json', type=argparse.FileType('w'), default=None, help='File to save results to.')
+    args = parser.parse_args()
+
+    cache = SummaryCache(args.cache)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for save_file in args.save_files:
+            phases = summarize_box(save_file, cache, args.settle, executor)
+            results[save_file] = compare_phases(phases, args.field)
+    cache.save()
+
+    for save_file, comparisons in results.items():
+        ratios = [c['ratio'] for c in comparisons if c['ratio'] is not None]
+        print('{}: {} A/B pairs, mean B/A ratio of {} {}'.format(
+            save_file, len(comparisons), args.field,
+            '{:.4f}'.format(sum(ratios) / len(ratios)) if ratios else 'n/a'))
+    if args.json is not None:
+        json.dump(results, args.json, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Raw serial transcripts: every command sent to a device and every chunk
+received from it, with monotonic timestamps, in a compact binary file. A
+transcript can be replayed through the same device classes and logging
+pipeline in place of the serial port, at real time, faster, or as fast as
+possible, so field captures double as repeatable benchmarks.
+
+A transcript starts with MAGIC, followed by records of a RECORD header
+(kind, monotonic time in ns, payload length) and the payload bytes.
+"""
+import bisect
+import fcntl
+import os
+import queue
+import select
+import struct
+import termios
+import threading
+import time
+
+import serial
+
+MAGIC = b'SERCAP1\n'
+RECORD = struct.Struct('<BqI')
+# Record kinds: bytes written to the device and bytes read from it.
+SENT = 0
+RECEIVED = 1
+
+
+def transcript_path(prefix, device_name):
+    """
+    Returns the transcript file for a device, e.g. capture.mcpc.cap.
+    """
+    return '{}.{}.cap'.format(prefix, device_name)
+
+
+class CaptureWriter(object):
+    """
+    Appends records to a transcript. Safe to share between threads.
+    """
+    def __init__(self, path, buffer_size=1 << 16):
+        """
+        Open the transcript for appending, writing the header if it is new.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab', buffering=buffer_size)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.records = 0
+
+    def write(self, kind, data: bytes):
+        """
+        Append a record of the given kind, stamped with the current time.
+        """
+        with self.lock:
+            self.file.write(RECORD.pack(kind, time.monotonic_ns(), len(data)))
+            self.file.write(data)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_transcript(path):
+    """
+    Yields the (kind, monotonic time in ns, data) records of a transcript.
+    A record cut short at the end of the file, e.g. by a crash, is ignored.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{!r} is not a serial transcript'.format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, t, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, t, data
+
+
+class ReplayFinished(serial.SerialException):
+    """
+    Raised when a command is sent to a ReplaySerial with no commands left in
+    its transcript.
+    """
+
+
+class ReplaySerial(object):
+    """
+    Stand-in for serial.Serial that answers from a transcript. Each command
+    written is matched to the next command in the transcript, and the chunks
+    received after it are delivered through a pipe with the delays they had,
+    divided by the speed. A command that differs from the next one in the
+    transcript is matched to the next identical command instead, if there is
+    one, so replies stay with the commands that asked for them. The pipe
+    gives the replay a real file descriptor, so selector and event loop
+    waits work unchanged.
+    """
+    def __init__(self, path, speed=1, port=None, baudrate=None, timeout=None, **kwargs):
+        """
+        path : The transcript to replay.
+        speed : How many times faster than captured to respond, 0 to respond
+                immediately.
+        The remaining arguments are those of serial.Serial, of which only the
+        timeout is used.
+        """
+        self.path = path
+        self.speed = speed
+        self.port = port
+        self.timeout = timeout
+        self.records = list(read_transcript(path))
+        # Index of the next record to replay.
+        self.position = 0
+        # Indexes of the command records, overall and by command.
+        self.sent = [i for i, (kind, _, _) in enumerate(self.records) if kind == SENT]
+        self.sent_by_command = {}
+        for i in self.sent:
+            self.sent_by_command.setdefault(self.records[i][2], []).append(i)
+        # Commands replayed, and those that differed from the transcript.
+        self.commands = 0
+        self.mismatches = 0
+        self._in, self._out = os.pipe()
+        os.set_blocking(self._in, False)
+        # Chunks waiting to be delivered, with the monotonic time they are
+        # due, None stops the sender.
+        self.outgoing = queue.Queue()
+        self.sender = threading.Thread(target=self._send_responses, daemon=True)
+        self.sender.start()
+        # Anything the device sent before the first command, e.g. a banner.
+        self._schedule_responses(None)
+
+    def _schedule_responses(self, sent_at):
+        now = time.monotonic()
+        while self.position < len(self.records) and self.records[self.position][0] == RECEIVED:
+            _, t, data = self.records[self.position]
+            delay = 0 if sent_at is None or not self.speed else (t - sent_at) / 1e9 / self.speed
+            self.outgoing.put((now + delay, data))
+            self.position += 1
+
+    def _find_command(self, data):
+        """
+        Returns the index of the next command record with the given bytes,
+        or of the next command record at all if none matches, or None at the
+        end of the transcript.
+        """
+        for indexes in (self.sent_by_command.get(data, []), self.sent):
+            i = bisect.bisect_left(indexes, self.position)
+            if i < len(indexes):
+                return indexes[i]
+        return None
+
+    def _send_responses(self):
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                return
+            due, data = item
+            time.sleep(max(due - time.monotonic(), 0))
+            try:
+                os.write(self._out, data)
+            except OSError:
+                return
+
+    def write(self, data):
+        data = bytes(data)
+        index = self._find_command(data)
+        if index is None:
+            raise ReplayFinished('End of transcript {!r}'.format(self.path))
+        _, sent_at, expected = self.records[index]
+        self.commands += 1
+        if index != self.position or data != expected:
+            self.mismatches += 1
+        self.position = index + 1
+        self._schedule_responses(sent_at)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        buf = fcntl.ioctl(self._in, termios.FIONREAD, b'\0\0\0\0')
+        return struct.unpack('i', buf)[0]
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = b''
+        while len(data) < size:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            if select.select([self._in], [], [], remaining)[0]:
+                data += os.read(self._in, size - len(data))
+        return data
+
+    def reset_input_buffer(self):
+        while self.in_waiting:
+            os.read(self._in, self.in_waiting)
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self._in
+
+    def close(self):
+        self.outgoing.put(None)
+        self.sender.join()
+        os.close(self._in)
+        os.close(self._out)
+
+
+def replay_transport(path, speed=1):
+    """
+    Returns a function opening a ReplaySerial of the transcript, to use as a
+    SerialDevice's transport in place of serial.Serial.
+    """
+    def open_replay(**kwargs):
+        return ReplaySerial(path, speed, **kwargs)
+    return open_replay
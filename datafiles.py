@@ -0,0 +1,217 @@
+"""
+Naming, compression and retention of the data files written by the logger.
+
+Rotated CSV files are compressed by a background thread, so rollover never
+waits on compression, and the oldest data files are pruned to keep the data
+directory within a disk budget. open_data_file() reads compressed and plain
+files alike.
+"""
+import datetime
+import glob
+import gzip
+import io
+import lzma
+import os
+import queue
+import re
+import shutil
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffix TimedRotatingFileHandler adds to daily rotated files, optionally
+# followed by a compression extension.
+ROTATED_SUFFIX = re.compile(r'^(\d{4}-\d{2}-\d{2})(\.(gz|xz|zst))?$')
+# Date in the name of a binary record file.
+RECORD_DATE = re.compile(r'\.(\d{4}-\d{2}-\d{2})(\.\d+)?\.rec$')
+# Extensions of the supported compression formats.
+COMPRESSIONS = ('gz', 'xz', 'zst')
+
+
+def _open_zstd(path, mode):
+    if zstandard is None:
+        raise ValueError('Reading {!r} needs the zstandard package'.format(path))
+    if 'r' in mode:
+        # Buffered for readline and line iteration.
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+
+
+OPENERS = {'gz': gzip.open, 'xz': lzma.open, 'zst': _open_zstd}
+
+
+def open_data_file(path):
+    """
+    Open a data file for reading in binary mode, decompressing it on the fly
+    if it ends in .gz, .xz or .zst.
+    """
+    ext = path.rsplit('.', 1)[-1]
+    if ext in OPENERS:
+        return OPENERS[ext](path, 'rb')
+    return open(path, 'rb')
+
+
+def is_compressed(path):
+    return path.rsplit('.', 1)[-1] in COMPRESSIONS
+
+
+def rotated_files(save_file):
+    """
+    Returns (date, path) pairs of the rotated CSV files of save_file,
+    compressed or not, oldest first.
+    """
+    files = []
+    for path in glob.glob(glob.escape(save_file) + '.*'):
+        match = ROTATED_SUFFIX.match(path[len(save_file) + 1:])
+        if match:
+            files.append((match.group(1), path))
+    return sorted(files)
+
+
+def record_files(save_file):
+    """
+    Returns (date, path) pairs of the binary record files of save_file,
+    oldest first.
+    """
+    files = []
+    for path in glob.glob(glob.escape(os.path.splitext(save_file)[0]) + '.*.rec'):
+        match = RECORD_DATE.search(path)
+        if match:
+            files.append((match.group(1), path))
+    return sorted(files)
+
+
+def all_file(save_file):
+    """
+    Returns the CSV file the full 'all' readings of save_file are logged to.
+    """
+    return os.path.splitext(save_file)[0] + '.all.csv'
+
+
+def data_files(save_file):
+    """
+    Returns the data files logged to save_file: rotated CSV files in date
+    order, the current CSV file, and any binary record files.
+    """
+    files = [path for _, path in rotated_files(save_file)]
+    if os.path.exists(save_file):
+        files.append(save_file)
+    files += [path for _, path in record_files(save_file)]
+    return files
+
+
+def _remove(path):
+    """
+    Remove a data file and its sidecar index, if any.
+    """
+    for p in (path, path + '.idx'):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+class Compressor(threading.Thread):
+    """
+    Background thread that compresses rotated CSV files and prunes the
+    oldest data files to stay within a disk budget. Use rotator() as the
+    rotator of the CSV file handlers so files are handed over at rollover.
+    Both save_file and its full 'all' readings (see all_file) are covered.
+    """
+    def __init__(self, save_file, compression='gz', budget=0):
+        """
+        save_file : The SAVE_FILE the logger writes to.
+        compression : Extension of the format to compress to ('gz', 'xz' or
+                      'zst'), or None to only prune.
+        budget : Maximum total bytes of data files, 0 for no limit.
+        """
+        super().__init__(name='compressor', daemon=True)
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression {!r}'.format(compression))
+        if compression == 'zst' and zstandard is None:
+            print('zstandard is not installed, compressing with gzip instead.')
+            compression = 'gz'
+        self.save_file = save_file
+        self.compression = compression
+        self.budget = budget
+        # Paths of rotated files waiting to be compressed, None stops.
+        self.queue = queue.Queue()
+
+    def rotator(self, source, dest):
+        """
+        Rotator for a logging rotating file handler: rename the file and its
+        sidecar index, if any, then queue it for compression without waiting.
+        """
+        os.rename(source, dest)
+        try:
+            os.rename(source + '.idx', dest + '.idx')
+        except FileNotFoundError:
+            pass
+        self.queue.put(dest)
+
+    def _csv_files(self):
+        return [self.save_file, all_file(self.save_file)]
+
+    def scan(self):
+        """
+        Queue rotated files left uncompressed, e.g. by an earlier crash, and
+        remove partial output of a compression it interrupted. The original
+        of a partial file is still there, so it is compressed again.
+        """
+        for csv_file in self._csv_files():
+            for path in glob.glob(glob.escape(csv_file) + '.*.tmp'):
+                os.remove(path)
+                print('Removed partially compressed {!r}.'.format(path))
+            for _, path in rotated_files(csv_file):
+                if not is_compressed(path):
+                    self.queue.put(path)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        path = None
+        while True:
+            try:
+                if path is not None and self.compression is not None:
+                    self.compress(path)
+                if self.budget:
+                    self.prune()
+            except OSError as e:
+                print('Failed to compress or prune {!r}: {}'.format(path, e))
+            path = self.queue.get()
+            if path is None:
+                return
+
+    def compress(self, path):
+        """
+        Compress a file next to itself, then remove the original.
+        """
+        dest = '{}.{}'.format(path, self.compression)
+        tmp = dest + '.tmp'
+        with open(path, 'rb') as src, OPENERS[self.compression](tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp, dest)
+        _remove(path)
+
+    def prune(self):
+        """
+        Remove the oldest rotated CSV and past days' binary files until all
+        data files fit within the budget.
+        """
+        files = [path for csv_file in self._csv_files() for path in data_files(csv_file)]
+        total = sum(os.path.getsize(path) for path in files)
+        today = datetime.date.today().isoformat()
+        candidates = [pair for csv_file in self._csv_files() for pair in rotated_files(csv_file)]
+        candidates += [(date, path) for date, path in record_files(self.save_file) if date < today]
+        for _, path in sorted(candidates):
+            if total <= self.budget:
+                break
+            size = os.path.getsize(path)
+            _remove(path)
+            total -= size
+            print('Pruned {!r} to stay within the disk budget.'.format(path))
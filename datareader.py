@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Time-range queries over the data files written by log-and-switch.py.
+
+Each CSV file gets a sparse sidecar index (<file>.idx) mapping timestamps to
+byte offsets, along with the file's first and last time. Queries skip files
+outside the range, binary search the index, seek, and stream the matching
+rows back as NumPy arrays. An index is rebuilt only when its file's size or
+modification time changes, and is extended rather than rebuilt when the file
+has only grown. Compressed rotated files are read as a stream, with offsets
+into the decompressed data.
+
+Run directly to print the rows in a time range:
+
+python3 datareader.py /mnt/data/data.csv --start 2020-11-01T12:00 --end 2020-11-01T13:00
+
+When the logger writes both CSV and binary record files, the same samples
+are in each, so only the binary files are read.
+"""
+import argparse
+import bisect
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+
+import storage
+from datafiles import data_files, is_compressed, open_data_file
+
+# Number of rows between index entries.
+INDEX_STRIDE = 256
+# Version of the index format, bumped to invalidate old indexes.
+INDEX_VERSION = 3
+
+
+def parse_time(text):
+    """
+    Returns the epoch time in seconds of an ISO 8601 timestamp, as written
+    by the CSV backend (local time).
+    """
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+class CSVIndex(object):
+    """
+    Sparse index of a CSV data file: a list of (time, offset, header) entries
+    every INDEX_STRIDE rows and wherever a header line starts a new set of
+    columns, plus the headers seen and the first and last time in the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Bytes of (decompressed) data indexed so far.
+        self.size = 0
+        # Size, modification time and inode of the file when it was indexed.
+        self.file_size = None
+        self.mtime = None
+        self.inode = None
+        self.min_time = None
+        self.max_time = None
+        self.headers = []
+        self.entries = []
+        # Rows since the last entry, so extending continues the stride.
+        self.rows_since_entry = 0
+
+    @property
+    def index_path(self):
+        return self.path + '.idx'
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the up-to-date index of a CSV file, loading the sidecar if it
+        is current, extending it if the file has only grown, and building it
+        otherwise. A sidecar of another file at the same path, e.g. one left
+        behind by a rollover, is rebuilt. The sidecar is saved when it changes.
+        """
+        index = cls(path)
+        stat = os.stat(path)
+        try:
+            with open(index.index_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        if (saved is not None and saved.get('version') == INDEX_VERSION
+                and saved['inode'] == stat.st_ino):
+            if saved['file_size'] == stat.st_size and saved['mtime'] == stat.st_mtime:
+                index.__dict__.update(saved['index'])
+                return index
+            # Plain files are only ever appended to.
+            if saved['file_size'] < stat.st_size and not is_compressed(path):
+                index.__dict__.update(saved['index'])
+        index._scan()
+        index.file_size, index.mtime, index.inode = stat.st_size, stat.st_mtime, stat.st_ino
+        index.save()
+        return index
+
+    def save(self):
+        """
+        Write the sidecar, ignoring read-only directories.
+        """
+        saved = {'version': INDEX_VERSION, 'file_size': self.file_size, 'mtime': self.mtime,
+                 'inode': self.inode,
+                 'index': {k: v for k, v in self.__dict__.items() if k != 'path'}}
+        try:
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump(saved, f)
+            os.replace(self.index_path + '.tmp', self.index_path)
+        except OSError:
+            pass
+
+    def _scan(self):
+        """
+        Index the file from the end of what is already indexed.
+        """
+        with open_data_file(self.path) as f:
+            f.seek(self.size)
+            offset = self.size
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Partially written row, index it next time.
+                    break
+                start, offset = offset, offset + len(line)
+                text = line.decode('utf-8').rstrip('\r\n')
+                if text.startswith('timestamp,'):
+                    columns = text.split(',')
+                    if not self.headers or self.headers[-1] != columns:
+                        self.headers.append(columns)
+                    self.rows_since_entry = INDEX_STRIDE
+                    continue
+                try:
+                    t = parse_time(text[:text.index(',')])
+                except ValueError:
+                    continue
+                if self.rows_since_entry >= INDEX_STRIDE or not self.entries:
+                    self.entries.append([t, start, len(self.headers) - 1])
+                    self.rows_since_entry = 0
+                self.rows_since_entry += 1
+                self.min_time = t if self.min_time is None else min(self.min_time, t)
+                self.max_time = t if self.max_time is None else max(self.max_time, t)
+        self.size = offset
+
+    def overlaps(self, start, end):
+        """
+        Returns whether the file may hold rows with start <= time < end.
+        """
+        if self.min_time is None:
+            return False
+        return (start is None or self.max_time >= start) and (end is None or self.min_time < end)
+
+    def seek_entry(self, start):
+        """
+        Returns the position in entries to start reading from for rows at or
+        after start.
+        """
+        if start is None:
+            return 0
+        times = [entry[0] for entry in self.entries]
+        return max(bisect.bisect_right(times, start) - 1, 0)
+
+
+def _to_arrays(header, rows):
+    """
+    Convert parsed rows to a dictionary of column name to NumPy array.
+    Timestamps become float epoch seconds and valve states strings; other
+    columns become floats, with NaN for values that are not numbers.
+    """
+    columns = {}
+    for i, name in enumerate(header):
+        values = [row[i] if i < len(row) else '' for row in rows]
+        if name == 'timestamp':
+            columns[name] = np.array([parse_time(v) for v in values])
+        elif name == 'valve':
+            columns[name] = np.array(values, dtype=str)
+        else:
+            converted = np.empty(len(values))
+            for j, v in enumerate(values):
+                try:
+                    converted[j] = float(v)
+                except ValueError:
+                    converted[j] = np.nan
+            columns[name] = converted
+    return columns
+
+
+def _query_csv(path, start, end, chunk_size, state):
+    """
+    Query one CSV file. state['header'] holds the columns in effect at the
+    end of the previous file, for files rotated without a header line, and
+    is updated for the next file.
+    """
+    index = CSVIndex.load(path)
+    inherited = state.get('header')
+    if index.headers:
+        state['header'] = index.headers[-1]
+    if not index.overlaps(start, end):
+        return
+    position = index.seek_entry(start)
+    _, offset, header_index = index.entries[position]
+    header = index.headers[header_index] if header_index >= 0 else inherited
+    if header is None:
+        raise ValueError('No header found for {!r}'.format(path))
+    rows = []
+    with open_data_file(path) as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            text = line.decode('utf-8').rstrip('\r\n')
+            if text.startswith('timestamp,'):
+                # Yield rows of the previous columns before switching.
+                if rows:
+                    yield _to_arrays(header, rows)
+                    rows = []
+                header = text.split(',')
+                continue
+            row = text.split(',')
+            try:
+                t = parse_time(row[0])
+            except ValueError:
+                continue
+            if start is not None and t < start:
+                continue
+            if end is not None and t >= end:
+                break
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield _to_arrays(header, rows)
+                rows = []
+    if rows:
+        yield _to_arrays(header, rows)
+
+
+def _query_binary(path, start, end, chunk_size):
+    records = storage.read_records(path)
+    meta, _ = storage.read_header(path)
+    timestamps = records['timestamp']
+    lo = 0 if start is None else np.searchsorted(timestamps, int(start * 1e9))
+    hi = len(records) if end is None else np.searchsorted(timestamps, int(end * 1e9))
+    states = np.array([s or '' for s in meta['valve_states']], dtype=str)
+    for i in range(lo, hi, chunk_size):
+        chunk = records[i:min(i + chunk_size, hi)]
+        columns = {name: chunk[name] for name in chunk.dtype.names}
+        columns['timestamp'] = chunk['timestamp'] / 1e9
+        columns['valve'] = states[chunk['valve']]
+        yield columns
+
+
+def query(files, start=None, end=None, chunk_size=4096, header=None):
+    """
+    Stream the rows with start <= time < end from the given data files.
+    files : List of CSV or binary record files, e.g. from data_files().
+    start, end : Epoch times in seconds, None for an open range.
+    chunk_size : Maximum number of rows per chunk.
+    header : Columns of a leading CSV file rotated without a header line,
+             if they are known from an earlier file.
+    Yields dictionaries of column name to NumPy array, one per chunk. Chunks
+    never mix columns from different headers.
+    """
+    state = {'header': header}
+    for path in files:
+        if path.endswith('.rec'):
+            yield from _query_binary(path, start, end, chunk_size)
+        else:
+            yield from _query_csv(path, start, end, chunk_size, state)
+
+
+def main():
+    """
+    Print the rows logged in a time range as CSV.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_file', help='The SAVE_FILE the logger writes to.')
+    parser.add_argument('--start', type=parse_time, default=None, help='ISO 8601 start time.')
+    parser.add_argument('--end', type=parse_time, default=None, help='ISO 8601 end time.')
+    args = parser.parse_args()
+
+    files = data_files(args.save_file)
+    # Read one format: the record files hold the same samples as the CSV
+    # files when both backends are enabled.
+    files = [path for path in files if path.endswith('.rec')] or files
+    header = None
+    for chunk in query(files, args.start, args.end):
+        names = list(chunk.keys())
+        if names != header:
+            header = names
+            print(','.join(names))
+        timestamps = [datetime.datetime.fromtimestamp(t).isoformat() for t in chunk['timestamp']]
+        for i, timestamp in enumerate(timestamps):
+            row = [timestamp] + [str(chunk[name][i]) for name in names[1:]]
+            sys.stdout.write(','.join(row) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Runs any number of MCPCs and valves from one configuration file, in one
+process. Every counter is sampled on its own schedule from a single asyncio
+event loop that waits on all of the serial ports at once, and all counters
+share one parse and storage pipeline, each writing to its own files. Valves
+follow their sequences from a common start, so valves with the same
+sequence switch at the same time.
+
+python3 devicerunner.py devices.ini
+
+See devices.ini.template for the configuration.
+"""
+import argparse
+import asyncio
+import configparser
+import time
+
+import metrics
+import serialdevices
+from datafiles import Compressor
+from pipeline import Pipeline, Sampler, parse_fsync_policy
+from scheduling import CommandRates, PeriodicSchedule, SequenceSchedule, parse_sequence
+from serialdevices import AsyncMCPC, MCPC, MCPCSchema, ThreeWayValve
+from storage import make_diagnostic_storages, make_storages
+from valvecontrol import ValveWorker
+
+# Device class for each role, unless a device's section names another class
+# from serialdevices.
+ROLES = {
+    'counter': MCPC,
+    'valve': ThreeWayValve,
+}
+
+# Options of the [logger] section, with their types and defaults.
+LOGGER_OPTIONS = [
+    # Maximum samples waiting in each pipeline queue.
+    ('queue_size', int, 1024),
+    # Maximum samples written per flush.
+    ('batch_size', int, 64),
+    # When to fsync written data: never, always, or a period in seconds.
+    ('fsync', str, 'never'),
+    # File to export metrics to, empty to disable, and the export period.
+    ('metrics_file', str, ''),
+    ('metrics_period', float, 60),
+    # Seconds between printed statistics.
+    ('report_period', float, 300),
+]
+
+# Options of counter sections. Options without a default are required.
+COUNTER_OPTIONS = [
+    ('port', str, None),
+    ('baud', int, 38400),
+    ('sampling_period', float, 1),
+    # Seconds between 'all' readings and settings checks, 0 to disable.
+    ('all_period', float, 60),
+    ('settings_period', float, 3600),
+    # Name of the valve whose state samples are tagged with, if any.
+    ('valve', str, ''),
+    ('save_file', str, None),
+    ('storage', str, 'csv'),
+    ('ring_file', str, ''),
+    ('ring_records', int, 3600),
+    ('settle_time', float, 10),
+    ('quantiles', str, '0.1,0.5,0.9'),
+    ('compress', str, 'gz'),
+    ('disk_budget', float, 0),
+]
+
+# Options of valve sections.
+VALVE_OPTIONS = [
+    ('port', str, None),
+    ('baud', int, 9600),
+    ('period', float, 10),
+    # Sequence of position:seconds[@speed] steps, see log-and-switch.py,
+    # empty to switch between a_open and b_open every period.
+    ('sequence', str, ''),
+    ('state_file', str, ''),
+]
+
+
+def read_section(config, name, options):
+    """
+    Returns the options of a configuration section as a namespace, the same
+    way log-and-switch.py reads its environment variables.
+    """
+    section = config[name]
+    ns = argparse.Namespace(name=name)
+    for option, modifier, default in options:
+        val = section.get(option, default)
+        if val is None:
+            raise ValueError('Required option {!r} is not set in [{}]!'.format(option, name))
+        setattr(ns, option, modifier(val))
+    return ns
+
+
+def device_class(config, name):
+    """
+    Returns the role and device class of a device section.
+    """
+    role = config[name].get('role')
+    if role not in ROLES:
+        raise ValueError('Unknown role {!r} in [{}], expected one of {}'.format(role, name, ', '.join(ROLES)))
+    class_name = config[name].get('class')
+    return role, ROLES[role] if class_name is None else getattr(serialdevices, class_name)
+
+
+class Runner(object):
+    """
+    Connects the configured devices and runs their sampling schedules as
+    tasks on one event loop, while valve workers follow their sequences.
+    """
+    def __init__(self, config):
+        """
+        Connect every device in the configuration. Valves are zeroed (or
+        their saved state restored) before the counters are connected.
+        config : configparser.ConfigParser with a [logger] section and one
+                 section per device.
+        """
+        if not config.has_section('logger'):
+            config.add_section('logger')
+        self.settings = read_section(config, 'logger', LOGGER_OPTIONS)
+        self.registry = metrics.REGISTRY
+        self.pipeline = Pipeline(queue_size=self.settings.queue_size, batch_size=self.settings.batch_size,
+                                 fsync=parse_fsync_policy(self.settings.fsync))
+        # Counter configurations and their AsyncMCPC front ends.
+        self.counters = []
+        # Valve configurations and ValveWorkers by name.
+        self.valves = {}
+        self.compressors = []
+        self.exporter = None
+        # Monotonic time the schedules start at, set by start().
+        self.start_time = None
+        devices = [(name,) + device_class(config, name) for name in config.sections() if name != 'logger']
+        for name, role, cls in devices:
+            if role == 'valve':
+                self._add_valve(read_section(config, name, VALVE_OPTIONS), cls)
+        for name, role, cls in devices:
+            if role == 'counter':
+                self._add_counter(read_section(config, name, COUNTER_OPTIONS), cls)
+
+    def _add_valve(self, cfg, cls):
+        valve = cls()
+        valve.name = cfg.name
+        valve.connect(port=cfg.port, baudrate=cfg.baud, state_file=cfg.state_file or None)
+        steps = parse_sequence(cfg.sequence or 'a_open:{0},b_open:{0}'.format(cfg.period))
+        cfg.steps = [(cls.position_name(pos), seconds, speed) for pos, seconds, speed in steps]
+        worker = ValveWorker(valve)
+        self.valves[cfg.name] = (cfg, worker)
+        self.registry.gauge('valve_' + cfg.name, worker.get_stats)
+
+    def _add_counter(self, cfg, cls):
+        if cfg.valve and cfg.valve not in self.valves:
+            raise ValueError('[{}] refers to unknown valve {!r}'.format(cfg.name, cfg.valve))
+        device = cls()
+        device.name = cfg.name
+        device.connect(port=cfg.port, baudrate=cfg.baud)
+        compressor = Compressor(cfg.save_file, None if cfg.compress == 'none' else cfg.compress,
+                                budget=int(cfg.disk_budget * 1e6))
+        self.compressors.append(compressor)
+        self.pipeline.add_source(cfg.name, MCPCSchema(), make_storages(cfg, rotator=compressor.rotator))
+        for command, storages in make_diagnostic_storages(cfg, rotator=compressor.rotator).items():
+            self.pipeline.add_source('{}:{}'.format(cfg.name, command), MCPCSchema(), storages)
+        self.counters.append((cfg, AsyncMCPC(device)))
+        self.registry.gauge('mcpc_response_' + cfg.name, device.get_response_latency)
+
+    def start(self):
+        """
+        Start the valve workers, compressors, pipeline and metrics exporter.
+        Valve sequences and sampling schedules all start now.
+        """
+        self.start_time = time.monotonic()
+        for cfg, worker in self.valves.values():
+            worker.follow(SequenceSchedule(cfg.steps, start=self.start_time))
+            worker.start()
+        for compressor in self.compressors:
+            compressor.scan()
+            compressor.start()
+        self.pipeline.start()
+        self.registry.gauge('pipeline_parse', lambda: self.pipeline.get_stats()['parse'])
+        self.registry.gauge('pipeline_writer', lambda: self.pipeline.get_stats()['writer'])
+        if self.settings.metrics_file:
+            self.exporter = metrics.MetricsExporter(self.registry, self.settings.metrics_file,
+                                                    self.settings.metrics_period)
+            self.exporter.start()
+
+    def stop(self):
+        """
+        Stop the valve workers, write out queued samples and stop the
+        background threads.
+        """
+        for _, worker in self.valves.values():
+            worker.stop()
+        self.pipeline.stop()
+        for compressor in self.compressors:
+            compressor.stop()
+        if self.exporter is not None:
+            self.exporter.stop()
+
+    async def run(self):
+        """
+        Sample every counter on its schedule until cancelled. The valves
+        follow their sequences on their worker threads meanwhile.
+        """
+        schedules = {}
+        tasks = []
+        for cfg, device in self.counters:
+            schedules[cfg.name] = PeriodicSchedule(cfg.sampling_period, start=self.start_time)
+            self.registry.gauge('sampling_' + cfg.name, schedules[cfg.name].get_stats)
+            tasks.append(self._sample(cfg, device, schedules[cfg.name]))
+        tasks.append(self._report(schedules))
+        await asyncio.gather(*tasks)
+
+    async def _sample(self, cfg, device, schedule):
+        """
+        Sample one counter on its schedule, tagging the samples with the
+        state of its valve. Its slower commands are sent in the gaps.
+        """
+        worker = self.valves[cfg.valve][1] if cfg.valve else None
+        sampler = Sampler(device, self.pipeline, self.registry, worker, source=cfg.name)
+        rates = CommandRates({'all': cfg.all_period, 'settings': cfg.settings_period})
+        self.registry.gauge('commands_' + cfg.name, rates.get_stats)
+        diagnostics = {'all': device.get_raw_all, 'settings': device.get_raw_settings}
+        while True:
+            await schedule.wait_async()
+            tick = sampler.begin()
+            try:
+                raw = await device.get_raw_reading()
+            except Sampler.errors as e:
+                sampler.failed('read', e)
+                continue
+            sampler.submit(tick, raw)
+            command = rates.next_command(schedule.next_deadline())
+            while command is not None:
+                start = time.monotonic()
+                timestamp = time.time_ns()
+                try:
+                    raw = await diagnostics[command]()
+                except Sampler.errors as e:
+                    sampler.failed(command, e)
+                    raw = None
+                rates.command_sent(command, start, time.monotonic())
+                if raw is not None:
+                    sampler.submit_diagnostic(command, timestamp, raw)
+                command = rates.next_command(schedule.next_deadline())
+
+    async def _report(self, schedules):
+        """
+        Print the statistics of every schedule, valve and the pipeline.
+        """
+        while True:
+            await asyncio.sleep(self.settings.report_period)
+            for name, schedule in schedules.items():
+                print('Sampling {}: {}'.format(name, schedule.format_stats()))
+            for name, (_, worker) in self.valves.items():
+                print('Valve {}: {}'.format(name, worker.format_stats()))
+            print('Pipeline: ' + self.pipeline.format_stats())
+
+
+def main():
+    """
+    Connect the devices listed in the configuration file and run them until
+    interrupted.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', help='INI file listing the devices, see devices.ini.template.')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        raise ValueError('Could not read configuration file {!r}'.format(args.config))
+    runner = Runner(config)
+    runner.start()
+    try:
+        asyncio.run(runner.run())
+    finally:
+        runner.stop()
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,18 @@ the vave at the valve period.
 """
 
 import argparse
-import datetime
 import os
 import time
-import logging
-import logging.handlers
 
-from serialdevices import MCPC, ThreeWayValve
+import metrics
+from capture import ReplayFinished, replay_transport, transcript_path
+from datafiles import Compressor
+from scheduling import CommandRates, PeriodicSchedule, SequenceSchedule, parse_sequence
+from serialdevices import MCPC, MCPCSchema, ThreeWayValve
+from pipeline import Pipeline, Sampler, parse_fsync_policy
+from publisher import Publisher
+from storage import make_diagnostic_storages, make_storages
+from valvecontrol import TRANSIT, ValveWorker, state_label
 
 # Default values for environment variables for program operation.
 # The MCPC_PORT, VALVE_PORT, and SAVE_FILE are set as environment
@@ -21,11 +26,66 @@ values = [
     ('MCPC_BAUD', int, 38400),
     ('VALVE_PORT', str, None),
     ('VALVE_BAUD', int, 9600),
+    # File the valve position is saved to, so a restart can skip zeroing the
+    # valve when it has not moved since. Empty to always zero.
+    ('VALVE_STATE_FILE', str, ''),
     ('VALVE_PERIOD', int, 10),
-    ('SAMPLING_PERIOD', int, 1),
+    # Valve sequence of comma separated position:seconds steps, each with an
+    # optional @speed, repeated, e.g. a_open:300,both:30,b_open:300@1600.
+    # Empty to switch between a_open and b_open every VALVE_PERIOD.
+    ('VALVE_SEQUENCE', str, ''),
+    ('SAMPLING_PERIOD', float, 1),
+    # Seconds between full 'all' readings and between settings checks, sent
+    # in the gaps between readings. 0 to disable.
+    ('ALL_PERIOD', float, 60),
+    ('SETTINGS_PERIOD', float, 3600),
     ('SAVE_FILE', str, 'data.csv'),
+    # Comma separated storage backends: csv, binary, ring and/or summary.
+    ('STORAGE', str, 'csv'),
+    # Memory-mapped file the ring backend keeps the most recent records in,
+    # e.g. in /dev/shm, empty for <save file base>.ring, and how many.
+    ('RING_FILE', str, ''),
+    ('RING_RECORDS', int, 3600),
+    # Unix socket path, or host:port, to publish live records and valve
+    # switches on (see publisher.py), empty to disable, and how many messages
+    # a subscriber may fall behind by before it is disconnected.
+    ('PUBLISH_ADDRESS', str, ''),
+    ('PUBLISH_BUFFER', int, 1024),
+    # Seconds at the start of each valve phase left out of phase summaries,
+    # and the quantiles to estimate for each field.
+    ('SETTLE_TIME', float, 10),
+    ('QUANTILES', str, '0.1,0.5,0.9'),
+    # Maximum samples waiting in each pipeline queue.
+    ('QUEUE_SIZE', int, 1024),
+    # Maximum samples written per flush.
+    ('BATCH_SIZE', int, 64),
+    # When to fsync written data: never, always, or a period in seconds.
+    ('FSYNC', str, 'never'),
+    # File to export metrics to (.json for JSON, Prometheus text otherwise),
+    # empty to disable, and the period in seconds to export at.
+    ('METRICS_FILE', str, ''),
+    ('METRICS_PERIOD', float, 60),
+    # Compression of rotated CSV files: gz, xz, zst or none.
+    ('COMPRESS', str, 'gz'),
+    # Megabytes the data files may take up before the oldest are removed,
+    # 0 for no limit.
+    ('DISK_BUDGET', float, 0),
+    # Path prefix to record the raw serial traffic of each device to, e.g.
+    # /mnt/data/capture gives /mnt/data/capture.mcpc.cap. Empty to disable.
+    ('CAPTURE_PREFIX', str, ''),
+    # Path prefix of transcripts to replay in place of the serial ports,
+    # which are then not opened. Empty to use the devices.
+    ('REPLAY_PREFIX', str, ''),
+    # How many times faster than captured to replay, 0 for as fast as
+    # possible. The sampling, command and valve step periods are shortened
+    # to match.
+    ('REPLAY_SPEED', float, 1),
 ]
 
+# Sampling period in seconds when replaying as fast as possible. The valve
+# period is shortened by the same factor.
+FASTEST_PERIOD = 1e-4
+
 def get_config():
     """
     Get the configuration information from the environment variables associated
@@ -42,47 +102,134 @@ def get_config():
 
 def main():
     """
-    Set up MCPC, valve, and data logger. Start valve switching at given valve
-    period while logging data at the given sampling period.
+    Set up MCPC, valve, and data logger. Start valve switching through the
+    valve sequence while logging data at the given sampling period.
     """
 
     cfg = get_config()
+    steps = parse_sequence(cfg.valve_sequence or 'a_open:{0},b_open:{0}'.format(cfg.valve_period))
+    steps = [(ThreeWayValve.position_name(pos), seconds, speed) for pos, seconds, speed in steps]
     m = MCPC()
-    m.connect(port=cfg.mcpc_port, baudrate=cfg.mcpc_baud)
     valve = ThreeWayValve()
-    valve.connect(port=cfg.valve_port, baudrate=cfg.valve_baud)
-
-    # Configure data logger for writing data to the CSV file.
-    data_logger = logging.Logger('data')
-    data_logger.setLevel(logging.INFO)
-    file_handler = logging.handlers.TimedRotatingFileHandler(cfg.save_file, when='D', interval=1)
-    data_logger.addHandler(file_handler)
-    formatter = logging.Formatter('%(message)s')
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.INFO)
-
-    # Write header value.
-    mcpc_data = m.get_reading()
-    data = {'timestamp': None, 'valve': None}
-    data.update(mcpc_data)
-    data_logger.info(','.join(map(str, data.keys())))
-
-    # Configure and start valve switching.
-    valve.open_a()
-    valve_period = cfg.valve_period # This value is in seconds.
-    valve_state = 'a'
-    valve_start = time.time()
-    while True:
-        timestamp = datetime.datetime.now().isoformat()
-        mcpc_data = m.get_reading()
-        data = {'timestamp': timestamp, 'valve': valve_state}
-        data.update(mcpc_data)
-        data_logger.info(','.join(map(str, data.values())))
-        if time.time() - valve_start > valve_period:
-            valve_state = 'a' if valve_state != 'a' else 'b'
-            valve.goto_pos(valve_state + '_open')
-            valve_start = time.time()
-        time.sleep(cfg.sampling_period)
+    for device in (m, valve):
+        if cfg.capture_prefix:
+            device.start_capture(transcript_path(cfg.capture_prefix, device.name))
+        if cfg.replay_prefix:
+            device.transport = replay_transport(transcript_path(cfg.replay_prefix, device.name),
+                                                cfg.replay_speed)
+    if cfg.replay_prefix:
+        scale = cfg.replay_speed or cfg.sampling_period / FASTEST_PERIOD
+        cfg.sampling_period /= scale
+        cfg.all_period /= scale
+        cfg.settings_period /= scale
+        steps = [(pos, seconds / scale, speed) for pos, seconds, speed in steps]
+    m.connect(port=cfg.mcpc_port, baudrate=cfg.mcpc_baud)
+    valve.connect(port=cfg.valve_port, baudrate=cfg.valve_baud,
+                  state_file=cfg.valve_state_file or None)
+    # Valve moves run on their own thread so they never delay sampling.
+    valve_worker = ValveWorker(valve)
+
+    # Rotated files are compressed and pruned in the background, so rollover
+    # only renames the file.
+    compressor = Compressor(cfg.save_file, None if cfg.compress == 'none' else cfg.compress,
+                            budget=int(cfg.disk_budget * 1e6))
+    compressor.scan()
+    compressor.start()
+
+    storages = make_storages(cfg, rotator=compressor.rotator)
+    publisher = None
+    if cfg.publish_address:
+        # Records reach subscribers as the pipeline writes them.
+        publisher = Publisher(cfg.publish_address, cfg.publish_buffer)
+        publisher.start()
+        storages.append(publisher)
+        valve_worker.add_listener(lambda state: publisher.event('valve', state=state_label(state)))
+
+    # Parsing and storage run on their own threads, so a slow write or a
+    # file rollover never delays the next reading.
+    pipeline = Pipeline(MCPCSchema(), storages,
+                        queue_size=cfg.queue_size, batch_size=cfg.batch_size,
+                        fsync=parse_fsync_policy(cfg.fsync))
+    for command, diagnostic_storages in make_diagnostic_storages(cfg, rotator=compressor.rotator).items():
+        pipeline.add_source(command, MCPCSchema(), diagnostic_storages)
+    pipeline.start()
+
+    # Both schedules tick at fixed offsets from the same start (in seconds),
+    # so time spent reading and writing does not add to either.
+    sampling = PeriodicSchedule(cfg.sampling_period)
+    sequence = SequenceSchedule(steps, start=sampling.start)
+    rates = CommandRates({'all': cfg.all_period, 'settings': cfg.settings_period})
+    diagnostics = {'all': m.get_raw_all, 'settings': m.get_raw_settings}
+    sampler = Sampler(m, pipeline, metrics.REGISTRY, valve_worker)
+
+    def report(state):
+        # Print the statistics whenever the valve arrives at a step.
+        if state != TRANSIT:
+            print('Sampling: ' + sampling.format_stats())
+            print('Valve: ' + valve_worker.format_stats())
+            print('Pipeline: ' + pipeline.format_stats())
+
+    # The worker sleeps until each step is due, starting the move early
+    # enough for the valve to arrive at the step's start.
+    valve_worker.add_listener(report)
+    valve_worker.follow(sequence)
+    valve_worker.start()
+
+    # Export device, sampling and pipeline metrics in the background.
+    registry = metrics.REGISTRY
+    registry.gauge('sampling', sampling.get_stats)
+    registry.gauge('commands', rates.get_stats)
+    registry.gauge('pipeline_parse', lambda: pipeline.get_stats()['parse'])
+    registry.gauge('pipeline_writer', lambda: pipeline.get_stats()['writer'])
+    registry.gauge('mcpc_response', m.get_response_latency)
+    registry.gauge('valve', valve_worker.get_stats)
+    registry.gauge('valve_schedule', lambda: {
+        'next_switch_seconds': valve_worker.upcoming()[0][0] - time.monotonic()})
+    if publisher is not None:
+        registry.gauge('publisher', publisher.get_stats)
+    exporter = None
+    if cfg.metrics_file:
+        exporter = metrics.MetricsExporter(registry, cfg.metrics_file, cfg.metrics_period)
+        exporter.start()
+
+    try:
+        while True:
+            sampling.wait()
+            tick = sampler.begin()
+            try:
+                raw = m.get_raw_reading()
+            except Sampler.errors as e:
+                sampler.failed('read', e)
+                continue
+            sampler.submit(tick, raw)
+            # Slower commands fill the time left before the next reading.
+            command = rates.next_command(sampling.next_deadline())
+            while command is not None:
+                start = time.monotonic()
+                timestamp = time.time_ns()
+                try:
+                    raw = diagnostics[command]()
+                except Sampler.errors as e:
+                    sampler.failed(command, e)
+                    raw = None
+                rates.command_sent(command, start, time.monotonic())
+                if raw is not None:
+                    sampler.submit_diagnostic(command, timestamp, raw)
+                command = rates.next_command(sampling.next_deadline())
+    except ReplayFinished:
+        print('Replay finished after {} readings.'.format(sampling.ticks))
+        print('Sampling: ' + sampling.format_stats())
+        print('Pipeline: ' + pipeline.format_stats())
+    finally:
+        valve_worker.stop()
+        valve_worker.join(valve_worker.idle_timeout)
+        # Closing also writes out the transcripts, if capturing.
+        m.close()
+        valve.close()
+        pipeline.stop()
+        compressor.stop()
+        if exporter is not None:
+            exporter.stop()
 
 if __name__ == '__main__':
     main()
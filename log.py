@@ -1,38 +1,110 @@
 #!/usr/bin/env python3
 """
-Log data from the mcpc to the given save file. This program does not use
-environment variables - instead, just pass the values for the MCPC port,
-the expected baudrate (if not default), and the savefile. This will
-continuously write the raw MCPC data to the file, so it will remain loosely
-formatted raw input.
+Capture raw MCPC readings to the given save file as fast as the link allows,
+for short characterization runs. This program does not use environment
+variables - instead, just pass the MCPC port, the expected baudrate (if not
+default), and the save file. Readings are requested back to back, or on a
+schedule if a period is given, and written unparsed as binary frames:
+
+    FRAME header (epoch time of the request in ns, length) + raw response
+
+The file starts with MAGIC. The achieved sample rate and any dropped or
+partial frames are reported at exit.
+
+python3 log.py /dev/ttyUSB0 capture.raw --duration 60
 """
 
 import argparse
+import struct
 import sys
-from time import sleep
+import time
+
+import serial
+
+from scheduling import PeriodicSchedule
 from serialdevices import MCPC
 
+MAGIC = b'MCPCRAW1\n'
+FRAME = struct.Struct('<qI')
+
+
+def read_frames(path):
+    """
+    Yields the (epoch time in ns, raw response) frames of a capture file. A
+    frame cut short at the end of the file is ignored.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{!r} is not a raw MCPC capture'.format(path))
+        while True:
+            header = f.read(FRAME.size)
+            if len(header) < FRAME.size:
+                return
+            timestamp, length = FRAME.unpack(header)
+            raw = f.read(length)
+            if len(raw) < length:
+                return
+            yield timestamp, raw
+
+
 def main():
     """
-    Log MCPC data to the save file.
+    Log raw MCPC data to the save file.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('mcpc_port')
+    parser.add_argument('save_file', help='File to append the frames to, - for stdout.')
     parser.add_argument('--mcpc-baud', type=int, required=False, default=115200)
-    parser.add_argument('save_file', type=argparse.FileType('w'), default=sys.stdout, nargs='?')
-    parser.add_argument('--period', type=int, required=False, default='1')
+    parser.add_argument('--period', type=float, required=False, default=0,
+                        help='Seconds between readings, 0 to request them back to back.')
+    parser.add_argument('--duration', type=float, required=False, default=0,
+                        help='Seconds to capture for, 0 to capture until interrupted.')
+    parser.add_argument('--buffer-size', type=int, required=False, default=1 << 20,
+                        help='Bytes buffered before writing to the save file.')
     args = parser.parse_args()
-    
+
     # Create and configure the mcpc instance.
     m = MCPC()
     m.connect(port=args.mcpc_port, baudrate=args.mcpc_baud)
-    f = args.savefile
+    if args.save_file == '-':
+        f = open(sys.stdout.fileno(), 'wb', buffering=args.buffer_size, closefd=False)
+    else:
+        f = open(args.save_file, 'ab', buffering=args.buffer_size)
+    if not f.seekable() or f.tell() == 0:
+        f.write(MAGIC)
 
-    # Log the raw data indefinitely.
-    while True:
-        data = m.get_reading()
-        f.write(data)
-        sleep(args.period)
+    schedule = PeriodicSchedule(args.period) if args.period > 0 else None
+    frames = partial = failed = size = 0
+    start = time.monotonic()
+    try:
+        while not args.duration or time.monotonic() - start < args.duration:
+            if schedule is not None:
+                schedule.wait()
+            timestamp = time.time_ns()
+            try:
+                raw = m.get_raw_reading()
+            except (serial.SerialException, AssertionError) as e:
+                print('Failed to read: {}'.format(e), file=sys.stderr)
+                failed += 1
+                continue
+            # A response that timed out before its trailing blank line.
+            if not raw.endswith(m.terminator):
+                partial += 1
+            f.write(FRAME.pack(timestamp, len(raw)))
+            f.write(raw)
+            frames += 1
+            size += FRAME.size + len(raw)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        f.close()
+        m.close()
+        elapsed = time.monotonic() - start
+        missed = schedule.missed if schedule is not None else 0
+        print('Captured {} frames ({} bytes) in {:.1f}s: {:.2f} frames/s, {} partial, '
+              '{} dropped ({} failed, {} missed ticks).'.format(
+                  frames, size, elapsed, frames / elapsed if elapsed else 0.0, partial,
+                  failed + missed, failed, missed), file=sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,182 @@
+"""
+Lightweight in-process metrics: counters, latency histograms and gauges,
+periodically exported to a file in Prometheus text format or as JSON. Updates
+only touch a dictionary under a lock, so they are cheap enough for the
+sampling hot path.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """
+    Counts of observed values per bucket, plus their sum and total count.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus one for values above the last bound.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Returns a list of (upper bound, count of values at or below it)
+        pairs, ending with an infinite bound.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+
+class Metrics(object):
+    """
+    Registry of named metrics. Counters and histograms are identified by
+    their name and labels; gauges are functions sampled at export time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add value to a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value, usually a latency in seconds, in a histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, prefix, func):
+        """
+        Register a function returning a dictionary of numbers, exported as
+        gauges named <prefix>_<key>. None values are left out.
+        """
+        with self.lock:
+            self.gauges[prefix] = func
+
+    def _gauge_values(self):
+        values = []
+        for prefix, func in list(self.gauges.items()):
+            for key, value in func().items():
+                if isinstance(value, (int, float)):
+                    values.append(('{}_{}'.format(prefix, key), value))
+        return values
+
+    def to_prometheus(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', le)]), count))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+        for name, value in self._gauge_values():
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> str:
+        """
+        Returns all metrics as a JSON document.
+        """
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                           'buckets': [[None if b == float('inf') else b, c] for b, c in h.cumulative()]}
+                          for (name, labels), h in sorted(self.histograms.items())]
+        gauges = dict(self._gauge_values())
+        return json.dumps({'time': time.time(), 'counters': counters,
+                           'histograms': histograms, 'gauges': gauges})
+
+    def export(self, path):
+        """
+        Write all metrics to path, as JSON if it ends in .json and in
+        Prometheus text format otherwise. The file is replaced atomically so
+        readers never see a partial export.
+        """
+        text = self.to_json() if path.endswith('.json') else self.to_prometheus()
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Thread exporting a registry to a file at a fixed period.
+    """
+    def __init__(self, metrics, path, period=60):
+        """
+        metrics : The Metrics registry to export.
+        path : File to export to, see Metrics.export.
+        period : float number of seconds between exports.
+        """
+        super().__init__(name='metrics', daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.period = period
+        self.stopped = threading.Event()
+
+    def _export(self):
+        # Any failure, including one raised by a gauge callback, only skips
+        # this export.
+        try:
+            self.metrics.export(self.path)
+        except Exception as e:
+            print('Failed to export metrics to {!r}: {!r}'.format(self.path, e))
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            self._export()
+
+    def stop(self):
+        """
+        Stop the exporter after one last export.
+        """
+        self.stopped.set()
+        self.join()
+        self._export()
+
+
+# Registry shared by the devices and the logger unless they are given their own.
+REGISTRY = Metrics()
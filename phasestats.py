@@ -0,0 +1,227 @@
+"""
+Streaming statistics for each valve phase. As samples are logged, running
+count, mean, variance, min/max and approximate quantiles are kept for every
+numeric MCPC field, and written out as one summary line per phase, so A-vs-B
+comparisons never need the raw data re-read.
+"""
+import datetime
+import json
+import math
+import os
+
+
+class P2Quantile(object):
+    """
+    Approximate quantile of a stream in constant memory, using the P-square
+    algorithm (Jain and Chlamtac, 1985).
+    """
+    def __init__(self, p):
+        """
+        p : The quantile to estimate, between 0 and 1.
+        """
+        self.p = p
+        # The first five values, until the markers can be set up.
+        self.initial = []
+        # Marker heights, actual positions and desired positions.
+        self.heights = None
+        self.positions = None
+        self.desired = None
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        """
+        Add a value to the stream.
+        """
+        if self.heights is None:
+            self.initial.append(x)
+            if len(self.initial) == 5:
+                self.heights = sorted(self.initial)
+                self.positions = [1, 2, 3, 4, 5]
+                p = self.p
+                self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+            return
+        q, n = self.heights, self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        # Move the middle markers towards their desired positions.
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        """
+        Returns the current estimate, or None if no values were added.
+        """
+        if self.heights is not None:
+            return self.heights[2]
+        if not self.initial:
+            return None
+        values = sorted(self.initial)
+        return values[int(round(self.p * (len(values) - 1)))]
+
+
+class RunningStats(object):
+    """
+    Count, mean and variance (Welford's algorithm), min, max and approximate
+    quantiles of a stream of numbers. NaN values are ignored.
+    """
+    def __init__(self, quantiles=(0.1, 0.5, 0.9)):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def add(self, x):
+        if x != x:
+            return
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        for quantile in self.quantiles:
+            quantile.add(x)
+
+    def variance(self):
+        """
+        Returns the sample variance, or None with fewer than two values.
+        """
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    def to_dict(self):
+        result = {
+            'count': self.count,
+            'mean': self.mean if self.count else None,
+            'var': self.variance(),
+            'min': self.min,
+            'max': self.max,
+        }
+        for quantile in self.quantiles:
+            result['q{:g}'.format(100 * quantile.p)] = quantile.value()
+        return result
+
+
+class PhaseSummaryStorage(object):
+    """
+    Storage backend that aggregates samples per valve phase instead of
+    storing them. A phase starts when the valve settles in a new position;
+    samples taken in transit or within the settling time of the phase start
+    are counted but left out of the statistics. Each finished phase is
+    appended to the summary file as one JSON line.
+    """
+    def __init__(self, path, settle_time=0, quantiles=(0.1, 0.5, 0.9)):
+        """
+        path : The JSON lines file to append summaries to.
+        settle_time : float number of seconds at the start of each phase to
+                      leave out of the statistics.
+        quantiles : Quantiles to estimate for every field.
+        """
+        self.path = path
+        self.settle_time_ns = int(settle_time * 1e9)
+        self.quantiles = quantiles
+        self.file = open(path, 'a')
+        # Names and positions of the numeric fields.
+        self.fields = []
+        self.indexes = []
+        self.valve = None
+        self.start_ns = None
+        self.end_ns = None
+        self.excluded = 0
+        self.stats = None
+
+    def set_schema(self, fields):
+        """
+        Set the fields of the samples to come. A change to the numeric
+        fields ends the current phase, marked incomplete, since they are no
+        longer comparable.
+        fields : List of (name, kind) pairs, see serialdevices.MCPCSchema.
+        """
+        indexes = [i for i, (_, kind) in enumerate(fields) if kind in ('i', 'f')]
+        if indexes == self.indexes and [fields[i][0] for i in indexes] == self.fields:
+            return
+        self._finish_phase(complete=False)
+        self.indexes = indexes
+        self.fields = [fields[i][0] for i in self.indexes]
+
+    def _start_phase(self, valve, timestamp_ns):
+        self.valve = valve
+        self.start_ns = timestamp_ns
+        self.end_ns = timestamp_ns
+        self.excluded = 0
+        self.stats = [RunningStats(self.quantiles) for _ in self.fields]
+
+    def _finish_phase(self, complete=True):
+        """
+        Write the summary of the current phase, if there is one.
+        """
+        if self.stats is None:
+            return
+        summary = {
+            'valve': self.valve,
+            'start': datetime.datetime.fromtimestamp(self.start_ns / 1e9).isoformat(),
+            'end': datetime.datetime.fromtimestamp(self.end_ns / 1e9).isoformat(),
+            'duration': (self.end_ns - self.start_ns) / 1e9,
+            'excluded': self.excluded,
+            'complete': complete,
+            'fields': {name: stats.to_dict() for name, stats in zip(self.fields, self.stats)},
+        }
+        self.file.write(json.dumps(summary) + '\n')
+        self.stats = None
+
+    def write(self, timestamp_ns, valve, values):
+        """
+        Add one sample to the current phase's statistics.
+        """
+        if valve in (None, 'transit'):
+            if self.stats is not None:
+                self.excluded += 1
+            return
+        if valve != self.valve or self.stats is None:
+            self._finish_phase()
+            self._start_phase(valve, timestamp_ns)
+        self.end_ns = timestamp_ns
+        if timestamp_ns - self.start_ns < self.settle_time_ns:
+            self.excluded += 1
+            return
+        for stats, i in zip(self.stats, self.indexes):
+            value = values[i]
+            if not isinstance(value, float) or math.isfinite(value):
+                stats.add(value)
+
+    def commit(self, fsync=False):
+        """
+        Flush written summaries, and sync them to disk if fsync is set.
+        """
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """
+        Write the unfinished phase, marked incomplete, and close the file.
+        """
+        self._finish_phase(complete=False)
+        self.file.close()
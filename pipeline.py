@@ -0,0 +1,401 @@
+"""
+Staged processing of samples. Acquisition hands raw responses to a parsing
+stage, which hands parsed records to a storage writer, each stage running on
+its own thread and connected by bounded queues. A slow disk therefore fills
+the queues instead of delaying the next serial request, and the queues count
+how often that happens.
+"""
+import queue
+import threading
+import time
+
+import serial
+
+from serialdevices import MCPC, SchemaDriftError
+from valvecontrol import TRANSIT, state_label
+
+
+def parse_fsync_policy(policy):
+    """
+    Parse an fsync policy: 'never', 'always' (after every batch) or a number
+    of seconds between fsyncs.
+    Returns None for never, otherwise the float interval in seconds.
+    """
+    if policy == 'never':
+        return None
+    if policy == 'always':
+        return 0.0
+    return float(policy)
+
+
+class Stage(threading.Thread):
+    """
+    A worker thread fed through a bounded queue. Subclasses implement
+    process(), which is called with each item in order.
+    """
+    def __init__(self, name, maxsize):
+        """
+        name : Thread name, also used in statistics.
+        maxsize : Maximum number of items waiting in the queue.
+        """
+        super().__init__(name=name, daemon=True)
+        self.queue = queue.Queue(maxsize)
+        # Number of items processed.
+        self.processed = 0
+        # Number of items dropped because the queue was full.
+        self.dropped = 0
+        # Number of puts that had to wait for space in the queue.
+        self.blocked = 0
+        # Deepest the queue has been.
+        self.max_depth = 0
+
+    def put(self, item, block=False) -> bool:
+        """
+        Queue an item for this stage. When the queue is full, the item is
+        dropped, or if block is set, the caller waits for space.
+        Returns whether the item was queued.
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if not block:
+                self.dropped += 1
+                return False
+            self.blocked += 1
+            self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def stop(self):
+        """
+        Stop the stage once everything already queued is processed.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def get_stats(self):
+        """
+        Returns a dictionary of queue depth and drop/backpressure counters.
+        """
+        return {
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'blocked': self.blocked,
+        }
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.process(item)
+            self.processed += 1
+
+    def process(self, item):
+        raise NotImplementedError
+
+
+class ParseStage(Stage):
+    """
+    Parses raw MCPC responses and enriches them into records for the writer.
+    Announces the schema to the writer before the first record, and again
+    whenever a complete response has a different field layout. Responses cut
+    short are dropped and counted. Each source (device) has its own schema.
+    """
+    def __init__(self, writer, maxsize):
+        """
+        writer : The WriterStage to pass records on to.
+        maxsize : Maximum number of raw responses waiting.
+        """
+        super().__init__('parse', maxsize)
+        self.writer = writer
+        # The serialdevices.MCPCSchema of each source, and the fields last
+        # announced for it.
+        self.schemas = {}
+        self.fields = {}
+        # Number of responses dropped for being cut short.
+        self.partial = 0
+
+    def add_source(self, source, schema):
+        """
+        Parse responses from source with schema. Sources are added before the
+        stage starts.
+        """
+        self.schemas[source] = schema
+        self.fields[source] = None
+
+    def process(self, item):
+        source, timestamp, valve, raw = item
+        schema = self.schemas[source]
+        if not raw.endswith(MCPC.terminator):
+            # A response cut short by a timeout is missing fields, which is
+            # no reason to relearn the layout.
+            self.partial += 1
+            print('Dropped partial response {!r}'.format(raw))
+            return
+        try:
+            try:
+                values = schema.parse(raw)
+            except SchemaDriftError as e:
+                print('MCPC schema drift, relearning: {}'.format(e))
+                schema.learn(raw)
+                values = schema.parse(raw)
+        except Exception as e:
+            print('Failed to parse response {!r}: {}'.format(raw, e))
+            return
+        if schema.fields != self.fields[source]:
+            self.fields[source] = schema.fields
+            self.writer.put(('schema', source, schema.fields), block=True)
+        # Waiting here applies backpressure to acquisition through this
+        # stage's queue rather than dropping parsed records.
+        self.writer.put(('record', source, timestamp, valve, values), block=True)
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['partial'] = self.partial
+        return stats
+
+    def stop(self):
+        super().stop()
+        self.writer.stop()
+
+
+class WriterStage(Stage):
+    """
+    Writes records to the storage backends of their source in batches. After
+    each batch the backends are flushed, and fsynced according to the fsync
+    policy.
+    """
+    def __init__(self, maxsize, batch_size=64, fsync=None):
+        """
+        maxsize : Maximum number of records waiting.
+        batch_size : Maximum number of records written per commit.
+        fsync : Seconds between fsyncs, 0 for every batch, None for never.
+        """
+        super().__init__('writer', maxsize)
+        # List of storage backends of each source.
+        self.storages = {}
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.last_fsync = time.monotonic()
+        # Number of commits made, and the slowest one in seconds.
+        self.commits = 0
+        self.max_commit_time = 0.0
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            # Block for the first item, then take whatever else is already
+            # waiting, so batching never adds latency.
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                stopping = True
+            for item in batch:
+                self.process(item)
+                self.processed += 1
+            self.commit()
+        for storage in self._all_storages():
+            storage.close()
+
+    def add_source(self, source, storages):
+        """
+        Write records from source to the given storage backends. Sources are
+        added before the stage starts.
+        """
+        self.storages[source] = storages
+
+    def _all_storages(self):
+        return [storage for storages in self.storages.values() for storage in storages]
+
+    def process(self, item):
+        if item[0] == 'schema':
+            _, source, fields = item
+            for storage in self.storages[source]:
+                storage.set_schema(fields)
+        else:
+            _, source, timestamp, valve, values = item
+            for storage in self.storages[source]:
+                storage.write(timestamp, valve, values)
+
+    def commit(self):
+        """
+        Flush every backend, fsyncing too if the policy calls for it.
+        """
+        start = time.monotonic()
+        fsync = self.fsync is not None and start - self.last_fsync >= self.fsync
+        for storage in self._all_storages():
+            storage.commit(fsync)
+        if fsync:
+            self.last_fsync = start
+        self.commits += 1
+        self.max_commit_time = max(self.max_commit_time, time.monotonic() - start)
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['commits'] = self.commits
+        stats['max_commit_time'] = self.max_commit_time
+        return stats
+
+
+class Pipeline(object):
+    """
+    Parse and storage stages fed by the acquisition loop. Submitting never
+    blocks: if the stages fall too far behind, samples are dropped and
+    counted instead.
+
+    Several devices can share one pipeline as separate sources, each with its
+    own schema and storage backends.
+    """
+    def __init__(self, schema=None, storages=None, queue_size=1024, batch_size=64, fsync=None):
+        """
+        schema : The serialdevices.MCPCSchema used to parse responses of the
+                 default source, None to only use sources added later.
+        storages : List of storage backends of the default source.
+        queue_size : Maximum number of items waiting in each queue.
+        batch_size : Maximum number of records written per commit.
+        fsync : Seconds between fsyncs, 0 for every batch, None for never.
+        """
+        self.writer = WriterStage(queue_size, batch_size, fsync)
+        self.parser = ParseStage(self.writer, queue_size)
+        if schema is not None:
+            self.add_source(None, schema, storages)
+
+    def add_source(self, source, schema, storages):
+        """
+        Add a device whose samples are submitted with the given source name,
+        parsed with schema and written to storages. Sources are added before
+        the pipeline starts.
+        """
+        self.parser.add_source(source, schema)
+        self.writer.add_source(source, storages)
+
+    def start(self):
+        self.writer.start()
+        self.parser.start()
+
+    def submit(self, timestamp, valve, raw, source=None) -> bool:
+        """
+        Queue a raw response for parsing and storage. Returns immediately.
+        timestamp : int nanoseconds since the epoch when the sample was taken.
+        valve : Valve state label for the sample.
+        raw : Raw response from the device.
+        source : Name of the source the response came from.
+        Returns whether the sample was queued rather than dropped.
+        """
+        return self.parser.put((source, timestamp, valve, raw))
+
+    def stop(self):
+        """
+        Write out everything queued and close the storage backends.
+        """
+        self.parser.stop()
+
+    def get_stats(self):
+        """
+        Returns a dictionary of statistics for each stage.
+        """
+        stats = {'parse': self.parser.get_stats(), 'writer': self.writer.get_stats()}
+        stats['parse']['drifts'] = sum(schema.drifts for schema in self.parser.schemas.values())
+        return stats
+
+    def format_stats(self):
+        """
+        Returns the statistics as a one line human readable summary.
+        """
+        return ' '.join(
+            '{}: depth={depth} max_depth={max_depth} dropped={dropped} blocked={blocked}'.format(name, **stats)
+            for name, stats in self.get_stats().items())
+
+
+class Sampler(object):
+    """
+    Bookkeeping around the readings of one counter, shared by the blocking
+    sampling loop of log-and-switch.py and the async one of devicerunner.py,
+    which make the device calls themselves:
+
+        tick = sampler.begin()
+        try:
+            raw = device.get_raw_reading()
+        except Sampler.errors as e:
+            sampler.failed('read', e)
+        else:
+            sampler.submit(tick, raw)
+
+    Readings are tagged with the state of the counter's valve, or as transit
+    if it changed during the reading, and a reading taken after a reconnect
+    is flagged as following a data gap.
+    """
+    # Errors that lose one response without losing the device: timeouts,
+    # garbled replies and silence.
+    errors = (serial.SerialException, AssertionError)
+
+    def __init__(self, device, pipeline, registry, worker=None, source=None):
+        """
+        device : The counter (MCPC or AsyncMCPC) sampled.
+        pipeline : The Pipeline to submit responses to.
+        registry : metrics.Metrics to count gaps, failures and drops in.
+        worker : The valvecontrol.ValveWorker of the counter's valve, if any.
+        source : Pipeline source name of the readings, also used to label
+                 metrics. Diagnostic responses go to <source>:<command>, or
+                 <command> without one.
+        """
+        self.device = device
+        self.pipeline = pipeline
+        self.registry = registry
+        self.worker = worker
+        self.source = source
+        self.labels = {} if source is None else {'device': source}
+
+    def valve_state(self):
+        return self.worker.get_state() if self.worker is not None else None
+
+    def begin(self):
+        """
+        Note the time, valve state and reconnect count before a reading.
+        Returns the tick to pass to submit.
+        """
+        return time.monotonic(), time.time_ns(), self.valve_state(), self.device.reconnects
+
+    def submit(self, tick, raw):
+        """
+        Tag a reading started at tick and queue it for storage.
+        """
+        tick_start, timestamp, state_before, reconnects = tick
+        if self.device.reconnects != reconnects:
+            # The reading was taken after reconnecting, and the samples due
+            # during the outage were never taken.
+            timestamp = time.time_ns()
+            print('Data gap of {:.1f}s while {} was disconnected.'.format(
+                self.device.last_outage, self.device.name))
+            self.registry.inc('data_gaps_total', **self.labels)
+            self.registry.inc('data_gap_seconds_total', self.device.last_outage, **self.labels)
+        # A sample taken while the valve changed state saw mixed air.
+        state_after = self.valve_state()
+        state = state_before if state_before == state_after else TRANSIT
+        if not self.pipeline.submit(timestamp, state_label(state), raw, source=self.source):
+            self.registry.inc('samples_dropped_total', **self.labels)
+        self.registry.observe('sample_loop_seconds', time.monotonic() - tick_start, **self.labels)
+
+    def submit_diagnostic(self, command, timestamp, raw):
+        """
+        Queue the response to a slower command, sent at timestamp.
+        """
+        source = command if self.source is None else '{}:{}'.format(self.source, command)
+        self.pipeline.submit(timestamp, state_label(self.valve_state()), raw, source=source)
+
+    def failed(self, command, error):
+        """
+        Report a command that got no usable response. Failed readings are
+        counted as samples_failed_total.
+        """
+        print('Failed to send {!r} to {}: {}'.format(command, self.device.name, error))
+        if command == 'read':
+            self.registry.inc('samples_failed_total', **self.labels)
@@ -0,0 +1,308 @@
+"""
+Live samples for local consumers. The publisher listens on a Unix domain
+socket (or a localhost TCP port) and pushes every record, plus events such as
+valve switches, to any number of subscribers without touching the disk.
+
+Every message is a FRAME header (payload length, kind) and a payload:
+SCHEMA carries the record layout as JSON (see storage.record_layout), RECORD
+a packed record in that layout, and EVENT a JSON object. Each subscriber
+gets the current schema on connecting. Subscribers have a bounded queue of
+frames; one that falls too far behind is disconnected, so a slow consumer
+never holds up the logger.
+"""
+import collections
+import json
+import os
+import selectors
+import socket
+import stat
+import struct
+import threading
+import time
+
+from storage import VALVE_STATES, encode_valve, record_layout
+
+FRAME = struct.Struct('<IB')
+# Message kinds.
+SCHEMA = 0
+RECORD = 1
+EVENT = 2
+# Struct codes for the NumPy types in a schema.
+FIELD_CODES = {'<i8': 'q', '<f8': 'd', 'u1': 'B'}
+
+
+def parse_address(address):
+    """
+    Returns the socket family and address for a Unix socket path or a
+    host:port pair.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+    return socket.AF_UNIX, address
+
+
+class Subscriber(object):
+    """
+    A connected consumer and the frames waiting to be sent to it.
+    """
+    def __init__(self, sock, max_pending):
+        self.sock = sock
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+        # Unsent tail of the frames taken off pending.
+        self.buffer = b''
+        # Set when the subscriber fell behind and is to be disconnected.
+        self.overrun = False
+
+
+class Publisher(threading.Thread):
+    """
+    Thread serving subscribers. It can be used as a storage backend to
+    publish the pipeline's records, and event() publishes anything else.
+    Records are queued as they are written and sent on commit().
+    """
+    def __init__(self, address, max_pending=1024):
+        """
+        Start listening.
+        address : Unix socket path, or host:port to listen on TCP.
+        max_pending : Frames a subscriber may fall behind by before it is
+                      disconnected.
+        """
+        super().__init__(name='publisher', daemon=True)
+        self.address = address
+        self.max_pending = max_pending
+        self.family, self.bind_address = parse_address(address)
+        if self.family == socket.AF_UNIX and os.path.exists(address):
+            # A socket left behind by an earlier run can go, anything else
+            # at the address is a misconfiguration.
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise ValueError('Publish address {!r} exists and is not a socket'.format(address))
+            os.remove(address)
+        self.server = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.bind_address)
+        self.server.listen()
+        self.server.setblocking(False)
+        # Written to to wake the thread when there is something to send.
+        self.wake_in, self.wake_out = socket.socketpair()
+        self.wake_in.setblocking(False)
+        self.wake_out.setblocking(False)
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.running = True
+        self.schema_frame = None
+        self.indexes = None
+        self.record = None
+        self.published = 0
+        self.connected = 0
+        self.dropped = 0
+
+    def _frame(self, kind, payload):
+        return FRAME.pack(len(payload), kind) + payload
+
+    def _broadcast(self, frame):
+        with self.lock:
+            self.published += 1
+            for subscriber in self.subscribers.values():
+                if len(subscriber.pending) >= subscriber.max_pending:
+                    subscriber.overrun = True
+                else:
+                    subscriber.pending.append(frame)
+
+    def _wake(self):
+        try:
+            self.wake_out.send(b'\0')
+        except BlockingIOError:
+            # Already woken.
+            pass
+
+    def set_schema(self, fields):
+        """
+        Publish the layout of the records to come.
+        fields : List of (name, kind) pairs, see serialdevices.MCPCSchema.
+        """
+        self.indexes, self.record, meta = record_layout(fields)
+        frame = self._frame(SCHEMA, json.dumps(meta).encode('utf-8'))
+        with self.lock:
+            self.schema_frame = frame
+        self._broadcast(frame)
+
+    def write(self, timestamp_ns, valve, values):
+        """
+        Queue one sample for every subscriber.
+        """
+        payload = self.record.pack(timestamp_ns, encode_valve(valve), *[values[i] for i in self.indexes])
+        self._broadcast(self._frame(RECORD, payload))
+
+    def commit(self, fsync=False):
+        """
+        Send the queued samples.
+        """
+        self._wake()
+
+    def event(self, name, **data):
+        """
+        Publish an event straight away, e.g. event('valve', state='b').
+        """
+        data = dict(data, event=name, timestamp=time.time_ns())
+        self._broadcast(self._frame(EVENT, json.dumps(data).encode('utf-8')))
+        self._wake()
+
+    def close(self):
+        """
+        Disconnect the subscribers and stop listening.
+        """
+        if not self.running:
+            return
+        self.running = False
+        self._wake()
+        if self.is_alive():
+            self.join()
+        self.server.close()
+        if self.family == socket.AF_UNIX:
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+        self.wake_in.close()
+        self.wake_out.close()
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the messages published and the subscribers
+        connected, current and dropped for falling behind.
+        """
+        with self.lock:
+            return {'published': self.published, 'subscribers': len(self.subscribers),
+                    'connected': self.connected, 'dropped': self.dropped}
+
+    def _accept(self):
+        try:
+            sock, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        subscriber = Subscriber(sock, self.max_pending)
+        with self.lock:
+            if self.schema_frame is not None:
+                subscriber.pending.append(self.schema_frame)
+            self.subscribers[sock] = subscriber
+            self.connected += 1
+
+    def _disconnect(self, subscriber):
+        with self.lock:
+            del self.subscribers[subscriber.sock]
+            if subscriber.overrun:
+                self.dropped += 1
+        subscriber.sock.close()
+
+    def _send(self, subscriber):
+        """
+        Send as much of the subscriber's queued frames as the socket takes.
+        """
+        with self.lock:
+            if subscriber.pending:
+                subscriber.buffer += b''.join(subscriber.pending)
+                subscriber.pending.clear()
+        try:
+            sent = subscriber.sock.send(subscriber.buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._disconnect(subscriber)
+            return
+        subscriber.buffer = subscriber.buffer[sent:]
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.server, selectors.EVENT_READ)
+        selector.register(self.wake_in, selectors.EVENT_READ)
+        registered = {}
+        while self.running:
+            # Forget disconnected sockets first, their descriptors may be
+            # reused by new subscribers.
+            for sock in [s for s in registered if s not in self.subscribers]:
+                selector.unregister(sock)
+                del registered[sock]
+            with self.lock:
+                subscribers = list(self.subscribers.values())
+            for subscriber in subscribers:
+                if subscriber.overrun:
+                    self._disconnect(subscriber)
+                    continue
+                # Reading only notices the subscriber closing.
+                events = selectors.EVENT_READ
+                if subscriber.buffer or subscriber.pending:
+                    events |= selectors.EVENT_WRITE
+                if subscriber.sock not in registered:
+                    selector.register(subscriber.sock, events, subscriber)
+                elif registered[subscriber.sock] != events:
+                    selector.modify(subscriber.sock, events, subscriber)
+                registered[subscriber.sock] = events
+            for key, events in selector.select(1):
+                if key.fileobj is self.server:
+                    self._accept()
+                elif key.fileobj is self.wake_in:
+                    try:
+                        self.wake_in.recv(4096)
+                    except BlockingIOError:
+                        pass
+                elif key.fileobj in self.subscribers:
+                    subscriber = key.data
+                    if events & selectors.EVENT_READ:
+                        try:
+                            data = subscriber.sock.recv(4096)
+                        except BlockingIOError:
+                            data = None
+                        except OSError:
+                            data = b''
+                        if data == b'':
+                            self._disconnect(subscriber)
+                            continue
+                    if events & selectors.EVENT_WRITE:
+                        self._send(subscriber)
+        selector.close()
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        for subscriber in subscribers:
+            self._disconnect(subscriber)
+
+
+def subscribe(address):
+    """
+    Connect to a publisher and yield its messages as (kind, message) pairs:
+    the schema dictionary, records as dictionaries of column name to value
+    (with the valve state label), and event dictionaries.
+    """
+    family, bind_address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(bind_address)
+    buffer = b''
+    record = names = None
+    try:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            buffer += data
+            while len(buffer) >= FRAME.size:
+                length, kind = FRAME.unpack_from(buffer)
+                if len(buffer) < FRAME.size + length:
+                    break
+                payload = buffer[FRAME.size:FRAME.size + length]
+                buffer = buffer[FRAME.size + length:]
+                if kind == SCHEMA:
+                    meta = json.loads(payload.decode('utf-8'))
+                    names = [name for name, _ in meta['fields']]
+                    record = struct.Struct('<' + ''.join(FIELD_CODES[t] for _, t in meta['fields']))
+                    yield kind, meta
+                elif kind == RECORD and record is not None:
+                    values = dict(zip(names, record.unpack(payload)))
+                    values['valve'] = VALVE_STATES[values['valve']]
+                    yield kind, values
+                elif kind == EVENT:
+                    yield kind, json.loads(payload.decode('utf-8'))
+    finally:
+        sock.close()
@@ -0,0 +1,313 @@
+"""
+Deadline-based scheduling for periodic work. Deadlines are exact multiples of
+the period on the monotonic clock, so time spent doing the work does not add
+to the period and the rate does not drift. Slower commands sharing a port
+with the periodic work are fitted into the gaps between its ticks. Valve
+sequences of steps with their own durations repeat on the same kind of
+fixed timeline.
+"""
+import asyncio
+import bisect
+import math
+import time
+
+
+class PeriodicSchedule(object):
+    """
+    Ticks at start + n * period on time.monotonic(). Ticks that are missed
+    entirely (e.g. because the work overran) are skipped rather than run back
+    to back, and the lateness of every tick is recorded as jitter.
+    """
+    def __init__(self, period, start=None):
+        """
+        Set up the schedule.
+        period : float number of seconds between ticks, may be below one.
+        start : monotonic time of the first tick, defaults to now.
+        """
+        if period <= 0:
+            raise ValueError('Period must be positive, got {!r}'.format(period))
+        self.period = period
+        self.start = time.monotonic() if start is None else start
+        # Index of the next tick to run.
+        self.tick = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Clear the jitter and overrun statistics.
+        """
+        # Number of ticks run.
+        self.ticks = 0
+        # Number of ticks skipped because they were already a period late.
+        self.missed = 0
+        # Number of ticks whose deadline had already passed when waited on.
+        self.overruns = 0
+        self.jitter_sum = 0.0
+        self.jitter_sq_sum = 0.0
+        self.jitter_max = 0.0
+
+    def next_deadline(self):
+        """
+        Returns the monotonic time of the next tick.
+        """
+        return self.start + self.tick * self.period
+
+    def _skip_missed(self, now):
+        """
+        Move the next tick up to the latest deadline that has passed, counting
+        the ticks in between as missed.
+        """
+        behind = int((now - self.next_deadline()) // self.period)
+        if behind > 0:
+            self.tick += behind
+            self.missed += behind
+
+    def _run_tick(self, now):
+        """
+        Record the jitter of the next tick and advance past it.
+        Returns the tick index.
+        """
+        jitter = now - self.next_deadline()
+        self.ticks += 1
+        self.jitter_sum += jitter
+        self.jitter_sq_sum += jitter * jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        tick = self.tick
+        self.tick += 1
+        return tick
+
+    def wait(self):
+        """
+        Sleep until the next tick.
+        Returns the int index of the tick, counting from the start.
+        """
+        now = time.monotonic()
+        if now > self.next_deadline():
+            # The first tick is due straight away, later ones only have
+            # passed if the work since the last tick took too long.
+            if self.ticks:
+                self.overruns += 1
+            self._skip_missed(now)
+        else:
+            time.sleep(self.next_deadline() - now)
+            now = time.monotonic()
+        return self._run_tick(now)
+
+    async def wait_async(self):
+        """
+        Async version of wait, for schedules run on an asyncio event loop.
+        Returns the int index of the tick, counting from the start.
+        """
+        now = time.monotonic()
+        if now > self.next_deadline():
+            if self.ticks:
+                self.overruns += 1
+            self._skip_missed(now)
+        else:
+            # The loop's timers may fire a little early.
+            while now < self.next_deadline():
+                await asyncio.sleep(self.next_deadline() - now)
+                now = time.monotonic()
+        return self._run_tick(now)
+
+    def due(self):
+        """
+        Check without sleeping whether the next tick has come. If so, it is
+        run (as with wait) and True is returned.
+        """
+        now = time.monotonic()
+        if now < self.next_deadline():
+            return False
+        self._skip_missed(now)
+        self._run_tick(now)
+        return True
+
+    def get_stats(self):
+        """
+        Returns a dictionary of tick, missed tick and overrun counts, and the
+        mean, standard deviation and maximum jitter in seconds.
+        """
+        mean = self.jitter_sum / self.ticks if self.ticks else 0.0
+        var = self.jitter_sq_sum / self.ticks - mean * mean if self.ticks else 0.0
+        return {
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'overruns': self.overruns,
+            'jitter_mean': mean,
+            'jitter_std': math.sqrt(max(var, 0.0)),
+            'jitter_max': self.jitter_max,
+        }
+
+    def format_stats(self):
+        """
+        Returns the statistics as a one line human readable summary.
+        """
+        return ('ticks={ticks} missed={missed} overruns={overruns} '
+                'jitter mean={jitter_mean:.6f}s std={jitter_std:.6f}s '
+                'max={jitter_max:.6f}s').format(**self.get_stats())
+
+
+def parse_sequence(text):
+    """
+    Parse a valve sequence of comma separated position:seconds steps, each
+    optionally followed by @speed, e.g. 'a_open:300,both:30@1600,b_open:300'.
+    The sequence repeats once the last step is over.
+    Returns a list of (position, seconds, speed) steps, with speed None where
+    none is given.
+    """
+    steps = []
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        step, _, speed = item.partition('@')
+        position, sep, seconds = step.partition(':')
+        if not sep:
+            raise ValueError('Sequence step {!r} is not position:seconds'.format(item))
+        seconds = float(seconds)
+        if seconds <= 0:
+            raise ValueError('Sequence step {!r} must last more than 0 seconds'.format(item))
+        steps.append((position.strip(), seconds, int(speed) if speed else None))
+    if not steps:
+        raise ValueError('Empty valve sequence {!r}'.format(text))
+    return steps
+
+
+class SequenceSchedule(PeriodicSchedule):
+    """
+    Ticks at the start of every step of a repeating sequence of steps of
+    different lengths, see parse_sequence. Tick n starts step n modulo the
+    number of steps, and its deadline is computed from the start of the
+    schedule, so like a PeriodicSchedule it never drifts.
+    """
+    def __init__(self, steps, start=None):
+        """
+        Set up the schedule.
+        steps : List of (position, seconds, speed) steps.
+        start : monotonic time of the first step, defaults to now.
+        """
+        self.steps = list(steps)
+        # Seconds from the start of each cycle to the start of each step.
+        self.offsets = []
+        cycle = 0.0
+        for _, seconds, _ in self.steps:
+            self.offsets.append(cycle)
+            cycle += seconds
+        super().__init__(cycle, start=start)
+
+    def deadline(self, tick):
+        """
+        Returns the monotonic time of the given tick.
+        """
+        cycles, index = divmod(tick, len(self.steps))
+        return self.start + cycles * self.period + self.offsets[index]
+
+    def next_deadline(self):
+        """
+        Returns the monotonic time of the next tick.
+        """
+        return self.deadline(self.tick)
+
+    def tick_at(self, t):
+        """
+        Returns the index of the last tick at or before monotonic time t,
+        -1 before the start.
+        """
+        if t < self.start:
+            return -1
+        cycles, into = divmod(t - self.start, self.period)
+        return int(cycles) * len(self.steps) + bisect.bisect_right(self.offsets, into) - 1
+
+    def _skip_missed(self, now):
+        behind = self.tick_at(now) - self.tick
+        if behind > 0:
+            self.tick += behind
+            self.missed += behind
+
+    def step(self, tick):
+        """
+        Returns the (position, seconds, speed) step started by a tick.
+        """
+        return self.steps[tick % len(self.steps)]
+
+    def step_at(self, t):
+        """
+        Returns the step scheduled at monotonic time t, None before the
+        start.
+        """
+        tick = self.tick_at(t)
+        return None if tick < 0 else self.step(tick)
+
+    def upcoming(self, count=1):
+        """
+        Returns the next count ticks, from the next one on, as a list of
+        (deadline, step) pairs.
+        """
+        return [(self.deadline(tick), self.step(tick)) for tick in range(self.tick, self.tick + count)]
+
+
+class CommandRates(object):
+    """
+    Slower commands sent in the gaps between the ticks of a faster schedule
+    on the same port. A command is due once its period has passed since it
+    was last sent, and is only sent when its expected duration fits before
+    the next tick, so it does not delay the fast command. A command that has
+    waited a whole period for a gap is sent anyway.
+    """
+    def __init__(self, periods):
+        """
+        periods : Dictionary of command name to float number of seconds
+                  between sends, e.g. {'all': 60, 'settings': 3600}. Commands
+                  with a period of 0 are never sent.
+        """
+        self.periods = {name: period for name, period in periods.items() if period > 0}
+        # Monotonic time each command is next due, all due at the start.
+        now = time.monotonic()
+        self.due_times = {name: now for name in self.periods}
+        # Smoothed duration in seconds of each command sent so far.
+        self.durations = {}
+        self.sent = {name: 0 for name in self.periods}
+        # Number of sends that could not wait any longer for a gap.
+        self.forced = {name: 0 for name in self.periods}
+
+    def next_command(self, deadline):
+        """
+        Returns the most overdue command that is due and expected to finish
+        before deadline (the monotonic time of the next tick), or None.
+        """
+        now = time.monotonic()
+        best, best_overdue = None, None
+        for name, period in self.periods.items():
+            overdue = now - self.due_times[name]
+            if overdue < 0:
+                continue
+            if now + self.durations.get(name, 0.0) > deadline and overdue < period:
+                continue
+            if best is None or overdue > best_overdue:
+                best, best_overdue = name, overdue
+        return best
+
+    def command_sent(self, name, start, end):
+        """
+        Record that a command was sent at start and completed at end, both
+        monotonic times.
+        """
+        period = self.periods[name]
+        if start - self.due_times[name] >= period:
+            self.forced[name] += 1
+        self.sent[name] += 1
+        self.due_times[name] = start + period
+        duration = self.durations.get(name, end - start)
+        self.durations[name] = duration + (end - start - duration) / 8
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the sends, forced sends and smoothed duration
+        of each command.
+        """
+        stats = {}
+        for name in self.periods:
+            stats[name + '_sent'] = self.sent[name]
+            stats[name + '_forced'] = self.forced[name]
+            stats[name + '_duration'] = self.durations.get(name)
+        return stats
@@ -2,14 +2,149 @@
 This file contains the source for the base SerialDevice and specific device
 implementations.
 """
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import json
+import os
+import selectors
 import serial
+import termios
 import time
 
+import metrics
+from capture import RECEIVED, SENT, CaptureWriter, ReplayFinished
+
+# Errors raised by calls on a serial connection that has gone away. Buffer
+# resets go straight to termios, which has its own error type.
+LINK_ERRORS = (serial.SerialException, OSError, termios.error)
+
+
+class DeviceDisconnected(serial.SerialException):
+    """
+    Raised when the serial connection of a device is missing or has dropped,
+    e.g. because its USB adapter was unplugged.
+    """
+
+
+def instrumented(command):
+    """
+    Decorator recording metrics for a SerialDevice method that carries out a
+    device command: latency to the first received byte and to completion,
+    bytes sent and received, and timeouts. Metrics are labelled with the
+    device name and the given command name.
+
+    If the connection has dropped, the outermost command reconnects (see
+    SerialDevice.reconnect) and is then retried once, counted as a retry.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            outer_first_rx = self._first_rx
+            self._first_rx = None
+            sent, received = self.bytes_sent, self.bytes_received
+            start = time.monotonic()
+            outermost = self._command_depth == 0 and not self._reconnecting
+            self._command_depth += 1
+            try:
+                try:
+                    return method(self, *args, **kwargs)
+                except DeviceDisconnected:
+                    if not outermost:
+                        raise
+                    self.reconnect()
+                    self.metrics.inc('serial_retries_total', device=self.name, command=command)
+                    return method(self, *args, **kwargs)
+            except serial.SerialTimeoutException:
+                self.metrics.inc('serial_timeouts_total', device=self.name, command=command)
+                raise
+            finally:
+                self._command_depth -= 1
+                end = time.monotonic()
+                first_rx = self._first_rx
+                m = self.metrics
+                m.observe('serial_command_seconds', end - start, device=self.name, command=command)
+                if first_rx is not None:
+                    m.observe('serial_first_byte_seconds', first_rx - start, device=self.name, command=command)
+                m.inc('serial_bytes_sent_total', self.bytes_sent - sent, device=self.name, command=command)
+                m.inc('serial_bytes_received_total', self.bytes_received - received,
+                      device=self.name, command=command)
+                # A command wrapping this one saw its first byte no later.
+                self._first_rx = outer_first_rx if outer_first_rx is not None else first_rx
+        return wrapper
+    return decorate
+
+
+class FrameBuffer(object):
+    """
+    Byte buffer sitting between a serial connection and the device methods.
+    Incoming data is appended in bulk and split into frames on a terminator,
+    so only complete frames are ever decoded.
+    """
+    def __init__(self, terminator=b'\n'):
+        """
+        Initialize an empty buffer.
+        terminator : Bytes marking the end of a frame.
+        """
+        self.terminator = terminator
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data: bytes):
+        """
+        Append raw data received from the device.
+        """
+        self.buffer += data
+
+    def take_until(self, marker: bytes):
+        """
+        Remove and return everything up to and including the first occurrence
+        of marker, or None if marker has not been received yet.
+        """
+        idx = self.buffer.find(marker)
+        if idx < 0:
+            return None
+        end = idx + len(marker)
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return data
+
+    def next_frame(self):
+        """
+        Remove and return the next complete frame (terminator included), or
+        None if no complete frame has been received yet.
+        """
+        return self.take_until(self.terminator)
+
+    def take(self, num_bytes: int = -1) -> bytes:
+        """
+        Remove and return up to num_bytes from the front of the buffer.
+        num_bytes : Number of bytes to take, defaults to everything buffered.
+        """
+        if num_bytes < 0:
+            num_bytes = len(self.buffer)
+        data = bytes(self.buffer[:num_bytes])
+        del self.buffer[:num_bytes]
+        return data
+
+    def clear(self):
+        """
+        Discard all buffered data.
+        """
+        self.buffer.clear()
+
+
 class SerialDevice(object):
     """
     General interface to connect to a device over serial.
     Individual devices should extend this interface for specific functionality.
     """
+    # Bytes marking the end of a response frame from the device.
+    terminator = b'\n'
+
     def __init__(self, encoding='utf-8'):
         """
         Initialize basic parameters associated with the serial device.
@@ -27,6 +162,41 @@ class SerialDevice(object):
         # If connection, etc. specifies 0 as the timeout, the class will
         # default to this instead.
         self.default_timeout = 10
+        # Data received from the device but not yet consumed.
+        self.reader = FrameBuffer(self.terminator)
+        # Selector used to block until the connection has data, or None when
+        # the connection has no file descriptor to wait on.
+        self.selector = None
+        # Interval in seconds to poll at when there is no selector.
+        self.poll_interval = 0.005
+        # Metrics registry and the device name used to label metrics.
+        self.metrics = metrics.REGISTRY
+        self.name = type(self).__name__.lower()
+        # Bytes transferred over the connection so far.
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Monotonic time the first byte of the current command's response
+        # was read, None until then.
+        self._first_rx = None
+        # Opens the connection, called with serial.Serial's arguments. Set
+        # to capture.replay_transport() to replay a transcript instead.
+        self.transport = serial.Serial
+        # Arguments to the transport, kept for reconnecting.
+        self.connect_args = None
+        # CaptureWriter recording the raw traffic, or None.
+        self.capture = None
+        # Seconds to wait before the first reconnection attempt, doubled
+        # after every failed attempt up to the maximum.
+        self.reconnect_delay = 0.1
+        self.max_reconnect_delay = 30
+        # Number of reconnections, and the length in seconds of the last
+        # outage.
+        self.reconnects = 0
+        self.last_outage = None
+        # Nesting of instrumented commands, and whether a reconnection is
+        # under way, so only the outermost command reconnects.
+        self._command_depth = 0
+        self._reconnecting = False
 
     def get_started_connection(self):
         """
@@ -45,23 +215,197 @@ class SerialDevice(object):
     def connect(self, port, baudrate, timeout=0, **kwargs):
         """
         Connect to the device over serial.
-        Prints if connection
+        Prints if connection fails, in which case the first command
+        reconnects.
         """
+        if timeout == 0:
+            timeout = self.default_timeout
+        self.connect_args = dict(port=port, baudrate=baudrate, timeout=timeout, **kwargs)
         try:
-            if timeout == 0:
-                timeout = self.default_timeout
             # This will throw an error if the connection fails.
-            self.cnxn = serial.Serial(port=port, baudrate=baudrate, timeout=timeout, **kwargs)
+            self.cnxn = self.transport(**self.connect_args)
             self.started_connection = True
         except:
             self.started_connection = False
             print("Failed to connect to device.")
+        else:
+            self._register_selector()
+
+    def reconnect(self):
+        """
+        Reopen a dropped connection, retrying with exponential backoff until
+        the port can be opened again. If the device was connected before,
+        _on_reconnect is then run to bring it back to a known state; if that
+        fails too, reconnecting starts over.
+        Returns the float number of seconds the device was unreachable.
+        """
+        if self.connect_args is None:
+            raise DeviceDisconnected('{} was never connected'.format(self.name))
+        start = time.monotonic()
+        print('Lost connection to {}, reconnecting.'.format(self.name))
+        delay = self.reconnect_delay
+        self._reconnecting = True
+        try:
+            while True:
+                self._close_connection()
+                self.metrics.inc('serial_reconnect_attempts_total', device=self.name)
+                try:
+                    self.cnxn = self.transport(**self.connect_args)
+                    self._register_selector()
+                    self.reader.clear()
+                    if self.started_connection:
+                        self._on_reconnect()
+                    break
+                except LINK_ERRORS as e:
+                    print('Reconnecting to {} failed, retrying in {:g}s: {}'.format(self.name, delay, e))
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_reconnect_delay)
+        finally:
+            self._reconnecting = False
+        self.started_connection = True
+        outage = time.monotonic() - start
+        self.reconnects += 1
+        self.last_outage = outage
+        self.metrics.inc('serial_reconnects_total', device=self.name)
+        self.metrics.observe('serial_outage_seconds', outage, device=self.name)
+        print('Reconnected to {} after {:.1f}s.'.format(self.name, outage))
+        return outage
+
+    def _on_reconnect(self):
+        """
+        Hook run after reconnecting, for subclasses to replay whatever set up
+        the device. Does nothing by default.
+        """
+
+    def _close_connection(self):
+        """
+        Close the connection and selector, ignoring errors from a connection
+        that has already gone away.
+        """
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.cnxn is not None:
+            try:
+                self.cnxn.close()
+            except LINK_ERRORS:
+                pass
+            self.cnxn = None
+
+    @contextlib.contextmanager
+    def _link(self):
+        """
+        Context for calls on the serial connection, turning the errors of a
+        missing or dropped connection into DeviceDisconnected.
+        """
+        if self.cnxn is None:
+            raise DeviceDisconnected('{} is not connected'.format(self.name))
+        try:
+            yield self.cnxn
+        except ReplayFinished:
+            raise
+        except LINK_ERRORS as e:
+            raise DeviceDisconnected('{} connection lost: {}'.format(self.name, e)) from e
+
+    def in_waiting(self) -> int:
+        """
+        Returns the number of bytes waiting on the serial connection.
+        """
+        with self._link() as cnxn:
+            return cnxn.in_waiting
+
+    def reset_input(self):
+        """
+        Drop all data received but not yet read.
+        """
+        with self._link() as cnxn:
+            cnxn.reset_input_buffer()
+        self.reader.clear()
+
+    def _register_selector(self):
+        """
+        Register the connection's file descriptor so waits can block on it.
+        Falls back to polling if the connection does not expose one.
+        """
+        try:
+            fd = self.cnxn.fileno()
+        except (AttributeError, OSError, ValueError):
+            return
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(fd, selectors.EVENT_READ)
 
     def close(self):
         """
-        Close the serial connection.
+        Close the serial connection, and the capture if there is one.
+        """
+        self._close_connection()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def start_capture(self, path):
+        """
+        Record every command sent and every chunk received, with monotonic
+        timestamps, to a transcript (see capture.py). Start before connecting
+        to include the traffic of setting up the device.
+        path : The transcript file, appended to if it exists.
+        """
+        self.capture = CaptureWriter(path)
+
+    def _received(self, data: bytes):
+        """
+        Account for data read from the connection.
         """
-        self.cnxn.close()
+        self.bytes_received += len(data)
+        if self.capture is not None and data:
+            self.capture.write(RECEIVED, data)
+
+    def fileno(self):
+        """
+        Returns the file descriptor of the serial connection.
+        """
+        return self.cnxn.fileno()
+
+    def _wait_readable(self, timeout) -> bool:
+        """
+        Block until the connection has data to read or timeout elapses.
+        timeout: float number of seconds to wait for.
+        Returns whether data is waiting.
+        """
+        if self.in_waiting() > 0:
+            return True
+        if self.selector is None:
+            time.sleep(min(self.poll_interval, timeout))
+        elif self.selector.select(timeout) and self.in_waiting() == 0:
+            self._read_hangup()
+        return self.in_waiting() > 0
+
+    def _read_hangup(self):
+        """
+        Called when the connection is readable but has nothing waiting, which
+        is how a hung up connection looks. Reading then raises
+        DeviceDisconnected if the connection is gone.
+        """
+        with self._link() as cnxn:
+            data = cnxn.read(1)
+        self.reader.feed(data)
+        self._received(data)
+
+    def _fill(self) -> int:
+        """
+        Move everything waiting on the serial connection into the frame buffer
+        with a single read.
+        Returns the int number of bytes read.
+        """
+        with self._link() as cnxn:
+            waiting = cnxn.in_waiting
+            data = cnxn.read(waiting) if waiting > 0 else b''
+        if waiting > 0:
+            self.reader.feed(data)
+            self._received(data)
+            if self._first_rx is None:
+                self._first_rx = time.monotonic()
+        return waiting
 
     def _read(self, num_bytes: int = 64) -> str:
         """
@@ -69,24 +413,33 @@ class SerialDevice(object):
         num_bytes: The int number of bytes to read, defaults to 64.
         Returns string of data read (length num_bytes).
         """
-        return self.cnxn.read(num_bytes).decode(self.encoding)
+        data = self.reader.take(num_bytes)
+        if len(data) < num_bytes:
+            with self._link() as cnxn:
+                rest = cnxn.read(num_bytes - len(data))
+            self._received(rest)
+            data += rest
+        return data.decode(self.encoding)
 
     def read_all(self) -> str:
         """
         Read all data returned by the device.
         Returns string of data read (returns entire buffer).
         """
-        buf = ''
-        while self.cnxn.in_waiting > 0:
-            buf += self.cnxn.read().decode(self.encoding)
-        return buf
+        self._fill()
+        return self.reader.take().decode(self.encoding)
 
     def _write(self, msg: str):
         """
         Write a serial command to the device.
         msg: String command to write to the device.
         """
-        self.cnxn.write(msg.encode(self.encoding))
+        data = msg.encode(self.encoding)
+        with self._link() as cnxn:
+            cnxn.write(data)
+        self.bytes_sent += len(data)
+        if self.capture is not None:
+            self.capture.write(SENT, data)
 
     def assert_response(self, msg):
         """
@@ -97,6 +450,35 @@ class SerialDevice(object):
         if msg not in response:
             raise serial.SerialException('Device did not return {!r}')
 
+    def _read_until(self, marker: bytes, timeout=0) -> bytes:
+        """
+        Wait until marker has been received and return the raw data up to and
+        including it. Anything received after the marker stays buffered.
+        marker: Bytes to wait for.
+        timeout: int number of seconds to wait for.
+        """
+        if timeout == 0:
+            timeout = self.default_timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            self._fill()
+            data = self.reader.take_until(marker)
+            if data is not None:
+                return data
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise serial.SerialTimeoutException(
+                    'Device timed out waiting for msg: {!r}'.format(marker.decode(self.encoding)))
+            self._wait_readable(remaining)
+
+    def read_frame(self, timeout=0) -> str:
+        """
+        Wait for the next complete frame, as delimited by the device terminator.
+        timeout: int number of seconds to wait for.
+        Returns the decoded frame, terminator included.
+        """
+        return self._read_until(self.terminator, timeout=timeout).decode(self.encoding)
+
     def wait_for(self, msg, timeout=0) -> str:
         """
         Wait for a specific message response for a specific amount of time.
@@ -104,16 +486,207 @@ class SerialDevice(object):
         timeout: int number of seconds to wait for.
         Returns full received buffer as a str.
         """
-        start = time.time()
-        buffer = ''
+        return self._read_until(msg.encode(self.encoding), timeout=timeout).decode(self.encoding)
+
+
+class AsyncSerialDevice(object):
+    """
+    Asyncio front end for a connected SerialDevice. Waits are driven by the
+    event loop watching the serial file descriptor, so many devices can share
+    one loop:
+
+        dev = AsyncSerialDevice(valve)
+        await dev.send_cmd('I')
+        await dev.wait_for('*', timeout=5)
+    """
+    def __init__(self, device: SerialDevice):
+        """
+        Wrap an already connected device.
+        device : The SerialDevice to drive from the event loop.
+        """
+        self.device = device
+
+    def __getattr__(self, name):
+        # Plain attributes and non-blocking helpers come from the device.
+        return getattr(self.device, name)
+
+    async def send_cmd(self, cmd):
+        """
+        Write a command to the device using its own framing.
+        """
+        self.device.send_cmd(cmd)
+
+    async def reconnect(self):
+        """
+        Async version of SerialDevice.reconnect. The backoff runs on the
+        loop's default executor, so other devices are served meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.device.reconnect)
+
+    async def _wait_readable(self, timeout) -> bool:
+        """
+        Suspend until the connection has data to read or timeout elapses.
+        timeout: float number of seconds to wait for.
+        Returns whether data is waiting.
+        """
+        device = self.device
+        if device.in_waiting() > 0:
+            return True
+        try:
+            fd = device.fileno()
+        except (AttributeError, OSError, ValueError):
+            await asyncio.sleep(min(device.poll_interval, timeout))
+            return device.in_waiting() > 0
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(True))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(fd)
+        if readable.done() and device.in_waiting() == 0:
+            device._read_hangup()
+        return device.in_waiting() > 0
+
+    async def _read_until(self, marker: bytes, timeout=0) -> bytes:
+        """
+        Async version of SerialDevice._read_until.
+        """
+        device = self.device
         if timeout == 0:
-            timeout = self.default_timeout
-        while time.time() - start < timeout:
-            if self.cnxn.in_waiting > 0:
-                buffer += self.cnxn.read().decode(self.encoding)
-                if msg in buffer:
-                    return buffer
-        raise serial.SerialTimeoutException('Device timed out waiting for msg: {!r}'.format(msg))
+            timeout = device.default_timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            device._fill()
+            data = device.reader.take_until(marker)
+            if data is not None:
+                return data
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise serial.SerialTimeoutException(
+                    'Device timed out waiting for msg: {!r}'.format(marker.decode(device.encoding)))
+            await self._wait_readable(remaining)
+
+    async def read_frame(self, timeout=0) -> str:
+        """
+        Async version of SerialDevice.read_frame.
+        """
+        data = await self._read_until(self.device.terminator, timeout=timeout)
+        return data.decode(self.device.encoding)
+
+    async def wait_for(self, msg, timeout=0) -> str:
+        """
+        Async version of SerialDevice.wait_for.
+        """
+        data = await self._read_until(msg.encode(self.device.encoding), timeout=timeout)
+        return data.decode(self.device.encoding)
+
+
+class SchemaDriftError(serial.SerialException):
+    """
+    Raised when an MCPC record does not match the expected field layout.
+    """
+
+
+class MCPCSchema(object):
+    """
+    Field layout of MCPC records: the field names in order and the type of
+    each value. The layout is declared up front or learned from the first
+    record, after which records are parsed straight from the raw bytes into
+    typed values. Records that do not match raise SchemaDriftError.
+    """
+    # Converters for each field kind: integer, floating point and string.
+    converters = {'i': int, 'f': float, 's': lambda v: v.decode('utf-8')}
+
+    def __init__(self, fields=None):
+        """
+        fields : List of (name, kind) pairs with kind 'i', 'f' or 's', or
+                 None to learn the layout from the first record.
+        """
+        self.fields = None
+        # Number of records that did not match the layout.
+        self.drifts = 0
+        if fields is not None:
+            self.set_fields(fields)
+
+    def set_fields(self, fields):
+        """
+        Set the layout and compile the per-field lookups.
+        """
+        self.fields = [(name, kind) for name, kind in fields]
+        self.names = [name for name, _ in self.fields]
+        self._keys = [name.encode('utf-8') for name in self.names]
+        self._converters = [self.converters[kind] for _, kind in self.fields]
+
+    @staticmethod
+    def _split(raw: bytes):
+        """
+        Split a raw record into (key, value) byte pairs, skipping blank lines.
+        """
+        pairs = []
+        for line in raw.split(b'\r'):
+            line = line.strip()
+            if line:
+                key, sep, value = line.partition(b'=')
+                if not sep:
+                    raise serial.SerialException("Couldn't parse data {!r}".format(line))
+                pairs.append((key, value.strip()))
+        return pairs
+
+    @staticmethod
+    def _kind(value: bytes):
+        """
+        Returns the kind of a raw value: 'f' for any number or 's'. Numbers
+        are always learned as floating point, since a reading such as
+        concent=0 may well be followed by a fractional one.
+        """
+        try:
+            float(value)
+        except ValueError:
+            return 's'
+        return 'f'
+
+    def learn(self, raw: bytes):
+        """
+        Set the layout from a raw record.
+        """
+        self.set_fields([(k.decode('utf-8'), self._kind(v)) for k, v in self._split(raw)])
+
+    def parse(self, raw: bytes):
+        """
+        Parse a raw record. Learns the layout first if there is none yet.
+        Returns a list of typed values in field order.
+        Execution looks like the following:
+        >>> MCPCSchema().parse(b'satfpwr=0  \\rconcent=1.5   \\rerr_num=0    \\r\\r')
+        [0.0, 1.5, 0.0]
+        """
+        if self.fields is None:
+            self.learn(raw)
+        pairs = self._split(raw)
+        if len(pairs) != len(self._keys):
+            self.drifts += 1
+            raise SchemaDriftError('Expected {} fields, got {}: {!r}'.format(
+                len(self._keys), len(pairs), [k for k, _ in pairs]))
+        values = []
+        for (key, value), expected, convert in zip(pairs, self._keys, self._converters):
+            if key != expected:
+                self.drifts += 1
+                raise SchemaDriftError('Expected field {!r}, got {!r}'.format(expected, key))
+            try:
+                values.append(convert(value))
+            except ValueError:
+                self.drifts += 1
+                raise SchemaDriftError('Field {!r} has unexpected value {!r}'.format(key, value))
+        return values
+
+    def to_dict(self, values):
+        """
+        Returns a dictionary of field name to value for parsed values.
+        """
+        return dict(zip(self.names, values))
 
 
 class MCPC(SerialDevice):
@@ -121,14 +694,31 @@ class MCPC(SerialDevice):
     Interface to a Brechtel Mixing Condensation Particle Counter device.
     Documentation at https://github.com/airpartners/logger/wiki/hardware-overview.
     """
-    def __init__(self, response_wait_time=0.2):
+    # Responses are a list of lines ending in a blank line.
+    terminator = b'\r\r'
+
+    def __init__(self, response_wait_time=2.0, adaptive=False):
         """
-        Initialize the MCPC with SerialDevice parameters and a measurement delay.
+        Initialize the MCPC with SerialDevice parameters and a response timeout.
+        response_wait_time : Maximum time in seconds to wait for a complete
+                             response before using whatever has arrived.
+        adaptive : If True, learn the typical response latency and stop
+                   waiting for missing terminators once a response is well
+                   overdue instead of always waiting response_wait_time.
         """
         super().__init__()
-        # Time in seconds to wait between sending a command and attempting to read the response.
-        # Default of .2 set via empirical testing and can be adjusted as needed.
+        # Upper bound in seconds on the wait for a complete response. Most
+        # responses end on their trailing blank line well before this.
         self.response_wait_time = response_wait_time
+        self.adaptive = adaptive
+        # Smoothed response latency and its mean deviation in seconds, None
+        # until the first complete response arrives.
+        self.latency = None
+        self.latency_dev = None
+        # Lower bound in seconds on the adaptive timeout.
+        self.min_response_wait_time = 0.1
+        # Field layout of read responses, learned from the first one.
+        self.schema = MCPCSchema()
 
     @staticmethod
     def _parse_values(data: str):
@@ -155,58 +745,319 @@ class MCPC(SerialDevice):
         """
         self._write(cmd + '\r\n')
 
+    def _request(self, cmd) -> bytes:
+        """
+        Send a command and wait for the full response, detected from its
+        trailing blank line. If the response does not complete in time,
+        whatever has arrived is returned instead.
+        cmd: The string command to write to the MCPC.
+        Returns the raw response.
+        """
+        # Drop leftovers of an earlier, late response so they are not
+        # mistaken for this one.
+        self.reset_input()
+        self.send_cmd(cmd)
+        start = time.monotonic()
+        try:
+            resp = self._read_until(self.terminator, timeout=self.get_response_timeout())
+        except serial.SerialTimeoutException:
+            # The partial response is returned, so the timeout is counted
+            # here rather than by instrumented.
+            resp = self.reader.take()
+            self._observe_timeout(cmd)
+        else:
+            self._observe_latency(time.monotonic() - start)
+        assert len(resp) > 0, "Device returned no data"
+        return resp
+
+    def _observe_latency(self, latency):
+        """
+        Fold a measured response latency into the smoothed estimate, using
+        the same gains as TCP retransmission timers.
+        """
+        if self.latency is None:
+            self.latency = latency
+            self.latency_dev = latency / 2
+        else:
+            self.latency_dev += (abs(latency - self.latency) - self.latency_dev) / 4
+            self.latency += (latency - self.latency) / 8
+
+    def _observe_timeout(self, cmd):
+        """
+        Count a response to cmd that failed to complete, and back the
+        adaptive timeout off.
+        """
+        self.metrics.inc('serial_timeouts_total', device=self.name, command=cmd)
+        if self.latency is not None:
+            self.latency_dev *= 2
+
+    def get_response_timeout(self):
+        """
+        Returns the time in seconds the next request waits for a complete
+        response. Outside adaptive mode this is the response wait time.
+        """
+        if not self.adaptive or self.latency is None:
+            return self.response_wait_time
+        timeout = self.latency + 4 * self.latency_dev
+        return min(max(timeout, self.min_response_wait_time), self.response_wait_time)
+
+    def get_response_latency(self):
+        """
+        Returns a dictionary with the smoothed response latency, its mean
+        deviation and the current response timeout, all in seconds. The
+        latency values are None until a complete response has been seen.
+        """
+        return {
+            'latency': self.latency,
+            'latency_dev': self.latency_dev,
+            'timeout': self.get_response_timeout(),
+        }
+
+    @instrumented('read')
+    def get_raw_reading(self) -> bytes:
+        """
+        Send the read command to the device, and return the unparsed response.
+        """
+        return self._request('read')
+
+    @instrumented('all')
+    def get_raw_all(self) -> bytes:
+        """
+        Send the all command to the device, and return the unparsed response.
+        """
+        return self._request('all')
+
+    @instrumented('settings')
+    def get_raw_settings(self) -> bytes:
+        """
+        Send the settings command to the device, and return the unparsed
+        response.
+        """
+        return self._request('settings')
+
+    @instrumented('read')
     def get_reading(self):
         """
         Send the read command to the device, and return the received data.
-        Returns parsed dictionary of values. Prints if the device
+        Returns parsed dictionary of typed values. Prints if the device
         receives no data.
         """
-        self.send_cmd('read')
-        time.sleep(self.response_wait_time)
-        resp = self.read_all()
-        assert len(resp) > 0, "Device returned no data"
-        return self._parse_values(resp)
+        return self.schema.to_dict(self.schema.parse(self._request('read')))
 
+    @instrumented('all')
     def get_all(self):
         """
         Get all values from the MCPC logger.
         Returns parsed dictionary of all values. Prints if the device
         receives no data.
         """
-        self.send_cmd('all')
-        time.sleep(self.response_wait_time)
-        resp = self.read_all()
-        assert len(resp) > 0, "Device returned no data"
-        return self._parse_values(resp)
+        return self._parse_values(self._request('all').decode(self.encoding))
 
+    @instrumented('settings')
     def get_settings(self):
         """
         Get the current settings associatd with the MCPC device.
         Returns parsed dictionary of all settings. Prints if the device
         receives no data.
         """
-        self.send_cmd('settings')
-        time.sleep(self.response_wait_time)
-        resp = self.read_all()
-        assert len(resp) > 0, "Device returned no data"
-        return self._parse_values(resp)
+        return self._parse_values(self._request('settings').decode(self.encoding))
 
     def get_response_wait_time(self):
         """
         Returns the (floating-point) response wait time associated with the
-        device (i.e. the set amount of time each method waits after sending
-        a command to read the response).
+        device (i.e. the longest time each method waits for a complete
+        response after sending a command).
         """
         return self.response_wait_time
 
     def set_response_wait_time(self, response_wait_time):
         """
         Set the (floating-point) response wait time associated with the
-        device (i.e. the set amount of time each method waits after sending
-        a command to read the response).
+        device (i.e. the longest time each method waits for a complete
+        response after sending a command).
         """
         self.response_wait_time = response_wait_time
 
+class AsyncMCPC(AsyncSerialDevice):
+    """
+    Asyncio front end for a connected MCPC, so many counters can be sampled
+    from one event loop.
+    """
+    async def _request(self, cmd) -> bytes:
+        """
+        Async version of MCPC._request. Reconnects and retries once if the
+        connection has dropped.
+        """
+        try:
+            return await self._send_request(cmd)
+        except DeviceDisconnected:
+            await self.reconnect()
+            self.device.metrics.inc('serial_retries_total', device=self.device.name, command=cmd)
+            return await self._send_request(cmd)
+
+    async def _send_request(self, cmd) -> bytes:
+        device = self.device
+        device.reset_input()
+        device.send_cmd(cmd)
+        start = time.monotonic()
+        try:
+            resp = await self._read_until(device.terminator, timeout=device.get_response_timeout())
+        except serial.SerialTimeoutException:
+            resp = device.reader.take()
+            device._observe_timeout(cmd)
+        else:
+            device._observe_latency(time.monotonic() - start)
+        device.metrics.observe('serial_command_seconds', time.monotonic() - start,
+                               device=device.name, command=cmd)
+        assert len(resp) > 0, "Device returned no data"
+        return resp
+
+    async def get_raw_reading(self) -> bytes:
+        """
+        Async version of MCPC.get_raw_reading.
+        """
+        return await self._request('read')
+
+    async def get_raw_all(self) -> bytes:
+        """
+        Async version of MCPC.get_raw_all.
+        """
+        return await self._request('all')
+
+    async def get_raw_settings(self) -> bytes:
+        """
+        Async version of MCPC.get_raw_settings.
+        """
+        return await self._request('settings')
+
+
+class CommandBatch(object):
+    """
+    BS1010 commands written back to back in one go, instead of waiting for
+    each acknowledgement before sending the next. The board carries out
+    commands in order, so replies are matched to commands in order. Each
+    queued command returns a concurrent.futures.Future holding its result
+    once the batch has run.
+    """
+    def __init__(self, device):
+        """
+        device : The connected BS1010 to send the commands to.
+        """
+        self.device = device
+        # Queued (command, timeout, handler, future) tuples. Commands that
+        # are not acknowledged have no timeout.
+        self.commands = []
+
+    def send(self, cmd, timeout=1, ack=True, handler=None):
+        """
+        Queue a command.
+        cmd : String command to send.
+        timeout : float number of seconds to wait for the reply, from when
+                  the reply before it arrived.
+        ack : Whether the board acknowledges the command.
+        handler : Function called with the reply (without the trailing
+                  asterisk) returning the command's result. Defaults to the
+                  reply itself.
+        Returns a Future of the command's result.
+        """
+        future = concurrent.futures.Future()
+        self.commands.append((cmd, timeout if ack else None, handler, future))
+        return future
+
+    def goto(self, pos: int):
+        """
+        Queue a move to a position, see BS1010.goto.
+        """
+        def moved(reply):
+            self.device.xpos = pos
+            self.device.save_state()
+        return self.send(str(pos) + 'G', handler=moved)
+
+    def get_pos(self):
+        """
+        Queue a position query, see BS1010.get_pos.
+        """
+        return self.send('-1?', handler=lambda reply: int(reply.split(',')[2]))
+
+    def set_pos(self, pos: int):
+        """
+        Queue setting the current position, see BS1010.set_pos.
+        """
+        def position_set(reply):
+            self.device.xpos = pos
+        return self.send(str(pos) + '=', handler=position_set)
+
+    def wait_for_idle(self, timeout=5):
+        """
+        Queue a wait for the motor to stop, see BS1010.wait_for_idle.
+        """
+        return self.send('I', timeout=timeout)
+
+    def report_latches(self):
+        """
+        Queue a limit switch status query, see BS1010.report_latches.
+        """
+        return self.send('L', handler=lambda reply: int(reply.split(',')[1]))
+
+    def set_runspeed(self, speed: int = 800):
+        """
+        Queue setting the run speed, see BS1010.set_runspeed.
+        """
+        def speed_set(reply):
+            self.device.runspeed = speed
+            self.device.save_state()
+        return self.send(str(speed) + 'R', handler=speed_set)
+
+    def run(self):
+        """
+        Write all queued commands at once, then read their replies in order.
+        A command that fails (e.g. times out) fails every command after it,
+        and the replies still on their way are waited out before raising, so
+        they are not taken for replies to later commands.
+        Returns the list of results, or raises the first failure.
+        """
+        commands, self.commands = self.commands, []
+        self.device.send_cmd(''.join(cmd for cmd, _, _, _ in commands))
+        error = None
+        # Timeouts of the replies still expected after a failure.
+        outstanding = []
+        for cmd, timeout, handler, future in commands:
+            if error is None:
+                try:
+                    reply = None
+                    if timeout is not None:
+                        reply = self.device.wait_for_ack(timeout=timeout)[:-1].strip()
+                    future.set_result(reply if handler is None else handler(reply))
+                except serial.SerialTimeoutException as e:
+                    error = e
+                    # The reply may just be late.
+                    outstanding.append(timeout)
+                except (serial.SerialException, ValueError, IndexError) as e:
+                    error = e
+            elif timeout is not None:
+                outstanding.append(timeout)
+            if error is not None:
+                future.set_exception(error)
+        if error is not None:
+            if not isinstance(error, DeviceDisconnected):
+                self._resync(outstanding)
+            raise error
+        return [future.result() for _, _, _, future in commands]
+
+    def _resync(self, timeouts):
+        """
+        Wait out the replies still expected after a failure, giving up at the
+        first that does not arrive, then drop anything else received.
+        timeouts : The float timeouts of the expected replies, in order.
+        """
+        for timeout in timeouts:
+            try:
+                self.device.wait_for_ack(timeout=timeout)
+            except serial.SerialTimeoutException:
+                break
+        self.device.reset_input()
+
+
 class BS1010(SerialDevice):
     """
     An interface to a BS1010 Stepper Motor Controller from Peter Norberg Consulting, Inc.
@@ -216,6 +1067,10 @@ class BS1010(SerialDevice):
     """
     # Rough range of motion from -X to +X limit switch.
     width = 2000
+    # Every command is acknowledged with a trailing asterisk.
+    terminator = b'*'
+    # Run speed set when zeroing, None to keep the board's default.
+    speed = None
 
     def __init__(self):
         """
@@ -225,33 +1080,115 @@ class BS1010(SerialDevice):
         # The current x position (as understood by the program).
         # TODO This would be useful for debugging, see issue 11.
         self.xpos = None
+        # The run speed last set, None for the board's default.
+        self.runspeed = None
+        # Whether the board has been zeroed since it was last reset.
+        self.zeroed = False
+        # File the position and run speed are saved to, see restore_state.
+        self.state_file = None
 
-    def connect(self, port, baudrate, timeout=0, reset=True, **kwargs):
+    def connect(self, port, baudrate, timeout=0, reset=True, state_file=None, **kwargs):
         """
         Connect to the board, and then zero the device.
+        state_file : File to save the position and run speed to. If the board
+                     still matches the saved state on connection, zeroing is
+                     skipped.
         """
         super().connect(port, baudrate, timeout=timeout, **kwargs)
-        # Reset and zero the device on connection.
-        if reset:
+        self.state_file = state_file
+        if not reset:
+            return
+        # Reset and zero the device on connection, unless it is known to be
+        # where it was left. If the board cannot be reached yet, wait for it
+        # with backoff as any command would, then check it.
+        while True:
+            try:
+                restored = self.restore_state()
+                break
+            except DeviceDisconnected:
+                self.reconnect()
+        if not restored:
+            self.reset()
+
+    def save_state(self):
+        """
+        Save the position and run speed to the state file, if there is one.
+        """
+        if self.state_file is None:
+            return
+        state = {'zeroed': self.zeroed, 'xpos': self.xpos, 'speed': self.runspeed}
+        try:
+            with open(self.state_file + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self.state_file + '.tmp', self.state_file)
+        except OSError as e:
+            print('Failed to save valve state to {!r}: {}'.format(self.state_file, e))
+
+    def restore_state(self):
+        """
+        Check the board against the saved state: it must not have been reset
+        or hit a limit switch since (no latches set), and must be at the
+        saved position once idle. If so, take on the saved state and run
+        speed. Returns whether the state was restored, i.e. whether zeroing
+        can be skipped.
+        """
+        if self.state_file is None:
+            return False
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not state.get('zeroed'):
+            return False
+        try:
+            self.reset_input()
+            batch = self.batch()
+            batch.wait_for_idle()
+            latches = batch.report_latches()
+            pos = batch.get_pos()
+            batch.run()
+            latches, pos = latches.result(), pos.result()
+        except DeviceDisconnected:
+            raise
+        except (serial.SerialException, ValueError, IndexError) as e:
+            print('Failed to check valve state, zeroing: {}'.format(e))
+            return False
+        if latches or pos != state['xpos']:
+            print('Valve at {} with latches {}, saved at {}, zeroing.'.format(pos, latches, state['xpos']))
+            return False
+        self.zeroed = True
+        self.xpos = pos
+        if state['speed'] is not None:
+            self.set_runspeed(state['speed'])
+        return True
+
+    def _on_reconnect(self):
+        """
+        The board may have lost power along with the connection, so check it
+        against the saved state and zero it again if that no longer holds.
+        """
+        if not self.restore_state():
             self.reset()
 
+    @instrumented('goto')
     def goto(self, pos: int):
         """
         Go to the specified numerical position value.
         Note: Returns when it has acknowledged the move, not when done moving.
         pos: int position to go to. Should be within width.
         """
-        self.send_cmd(str(pos) + 'G')
-        self.wait_for_ack()
+        self._run_one('goto', pos)
 
+    @instrumented('get_pos')
     def get_pos(self):
         """
         Returns the current position value, as understood by the board.
         Returns int position values, with X position followed by Y position.
         """
-        self.send_cmd('-1?')
-        return int(self.wait_for_ack()[:-1].strip().split(',')[2])
+        return self._run_one('get_pos')
 
+    @instrumented('set_pos')
     def set_pos(self, pos: int):
         """
         Set the position of the motor, as specified by pos. Note that this will
@@ -259,25 +1196,25 @@ class BS1010(SerialDevice):
         the posiion.
         pos : int value for the position of the motor. Should be within width.
         """
-        self.send_cmd(str(pos) + '=')
-        self.wait_for_ack()
+        self._run_one('set_pos', pos)
 
     def wait_for_ack(self, timeout=1):
         """
         Wait for the acknowledgement response over the serial connection.
         timeout: int number of seconds to wait for execution.
         """
-        return self.wait_for('*', timeout=timeout)
+        return self.read_frame(timeout=timeout)
 
+    @instrumented('wait_for_idle')
     def wait_for_idle(self, timeout=5):
         """
         Waits for the motor to become idle after moving.
         timeout: int number of seconds to wait for execution. Note that this
                  will need to increase with higher speeds.
         """
-        self.send_cmd('I')
-        self.wait_for_ack(timeout=timeout)
+        self._run_one('wait_for_idle', timeout)
 
+    @instrumented('report_latches')
     def report_latches(self):
         """
         Return limit switch status. See page 43 in the BS1010 manual in the
@@ -290,32 +1227,58 @@ class BS1010(SerialDevice):
             16: Reset operation
         Returns int latches value.
         """
-        self.send_cmd('L')
-        resp = self.wait_for_ack()
-        # Clean output.
-        resp = resp[:-1].strip()
-        _, value = resp.split(',')
-        return int(value)
+        return self._run_one('report_latches')
 
-    def reset(self):
+    def batch(self):
+        """
+        Returns a CommandBatch for sending several commands in one go.
+        """
+        return CommandBatch(self)
+
+    def _run_one(self, command, *args):
+        """
+        Run a single command of a CommandBatch and return its result.
         """
-        Reset the connection and zero the board.
+        batch = self.batch()
+        future = getattr(batch, command)(*args)
+        batch.run()
+        return future.result()
+
+    @instrumented('reset')
+    def reset(self):
         """
-        self.cnxn.flush()
-        self.send_cmd('!')  # Reset command.
-        self.wait_for_ack()
-        l = self.report_latches()
-        assert l & 16
+        Reset the connection and zero the board, then set the run speed if
+        one is given. The reset command goes on its own, since the board may
+        drop bytes that arrive while it resets. The rest are sent in batches,
+        each ending with the reply that the next batch depends on.
+        """
+        # Invalidate the saved state until the board is zeroed again.
+        self.zeroed = False
+        self.runspeed = None
+        self.save_state()
+        with self._link() as cnxn:
+            cnxn.flush()
+        self.reader.clear()
+        self._run_one('send', '!')  # Reset command.
+        batch = self.batch()
+        l = batch.report_latches()
+        batch.run()
+        assert l.result() & 16
 
         # Zero the valve.
-        self.send_cmd('X')  # TODO:See issue 12.
-        self.goto(-(self.width + 1000))
-        self.wait_for_idle()
-        l = self.report_latches()
-        assert l & 4  # TODO:See issue 12.
-        self.set_pos(-100)
-        self.goto(0)
-        self.wait_for_idle()
+        batch.send('X', ack=False)  # TODO:See issue 12.
+        batch.goto(-(self.width + 1000))
+        batch.wait_for_idle()
+        l = batch.report_latches()
+        batch.run()
+        assert l.result() & 4  # TODO:See issue 12.
+        self.zeroed = True
+        batch.set_pos(-100)
+        batch.goto(0)
+        batch.wait_for_idle()
+        if self.speed is not None:
+            batch.set_runspeed(self.speed)
+        batch.run()
 
     def send_cmd(self, cmd):
         """
@@ -324,13 +1287,13 @@ class BS1010(SerialDevice):
         """
         self._write(cmd)
 
+    @instrumented('set_runspeed')
     def set_runspeed(self, speed: int = 800):
         """
         Set the valve speed in pulses/second/second.
         speed: Int speed value. Defaults to 8000, stop is 80, maxes at 57600.
         """
-        self.send_cmd(str(speed) + 'R')
-        self.wait_for_ack()
+        self._run_one('set_runspeed', speed)
 
 class ThreeWayValve(BS1010):
     """
@@ -344,22 +1307,48 @@ class ThreeWayValve(BS1010):
         'b_open': 2000,
         'both': 1000,
     }
-    # The valve's default speed in pulses/second/second.
+    # The valve's default speed in pulses/second/second, set when zeroing.
     speed = 3200
 
-    def reset(self):
-        """
-        Reset and zero the valve. Set the speed to the ThreeWayValve default.
-        """
-        super().reset()
-        self.set_runspeed(self.speed)
-
     def goto_pos(self, pos: str):
         """
         Move to a named position from self.positions.
         """
         self.goto(self.positions[pos])
 
+    @classmethod
+    def position_name(cls, name: str):
+        """
+        Returns the named position a name refers to, allowing the short
+        labels used in data records, e.g. 'a' for 'a_open'.
+        """
+        for candidate in (name, name + '_open'):
+            if candidate in cls.positions:
+                return candidate
+        raise ValueError('Unknown valve position {!r}, expected one of {}'.format(
+            name, ', '.join(cls.positions)))
+
+    @instrumented('move')
+    def move_to(self, pos: str, timeout=5, speed=None):
+        """
+        Move to a named position and wait for the motor to stop, sending the
+        move, the wait and a position check as one batch.
+        timeout: int number of seconds to wait for the move to finish.
+        speed: int run speed to move at, if it differs from the current one.
+        Returns the float number of seconds from sending the move until the
+        motor was idle, and the int position the board reports after it.
+        """
+        batch = self.batch()
+        if speed is not None and speed != self.runspeed:
+            batch.set_runspeed(speed)
+        start = time.monotonic()
+        batch.goto(self.positions[pos])
+        idle_times = []
+        batch.wait_for_idle(timeout=timeout).add_done_callback(lambda _: idle_times.append(time.monotonic()))
+        reached = batch.get_pos()
+        batch.run()
+        return idle_times[0] - start, reached.result()
+
     def open_a(self):
         """
         Move to position a, as specified in the self.positions.
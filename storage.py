@@ -0,0 +1,564 @@
+"""
+Storage backends for logged samples. Every backend receives the same records:
+a timestamp in integer nanoseconds since the epoch, the valve state label and
+the list of typed MCPC values, in the order of the fields last passed to
+set_schema.
+
+The binary backend writes fixed-schema typed records to append-only files,
+one per day, that can be memory-mapped straight into NumPy arrays. The ring
+backend writes the same records into a fixed-size memory-mapped file holding
+only the most recent ones, for local readers to watch.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import mmap
+import os
+import struct
+
+from datafiles import all_file
+from phasestats import PhaseSummaryStorage
+
+# Magic bytes at the start of every binary record file.
+MAGIC = b'MCPCREC1'
+# Header layout: magic followed by the length of the JSON schema.
+HEADER = struct.Struct('<8sI')
+# Valve state labels, stored in records by their index.
+VALVE_STATES = [None, 'a', 'b', 'both', 'transit']
+# Struct and NumPy codes for each column kind.
+STRUCT_CODES = {'i': 'q', 'f': 'd'}
+DTYPE_CODES = {'i': '<i8', 'f': '<f8'}
+# Magic bytes at the start of every ring buffer file.
+RING_MAGIC = b'MCPCRNG1'
+# Ring header layout: magic, number of records ever written (the write
+# cursor), capacity in records and the length of the JSON schema that
+# follows. Records start at RING_DATA_OFFSET.
+RING_HEADER = struct.Struct('<8sQQI')
+RING_CURSOR = struct.Struct('<Q')
+RING_CURSOR_OFFSET = 8
+RING_DATA_OFFSET = 4096
+
+
+def encode_valve(label):
+    """
+    Returns the small integer code stored for a valve state label.
+    """
+    try:
+        return VALVE_STATES.index(label)
+    except ValueError:
+        return 0
+
+
+def record_layout(fields):
+    """
+    Returns the layout of the fixed-size record for the given fields: the
+    positions of the numeric fields within a sample's values, the record
+    Struct, and the JSON-ready schema with the NumPy type of every column.
+    fields : List of (name, kind) pairs, see serialdevices.MCPCSchema.
+    """
+    indexes = [i for i, (_, kind) in enumerate(fields) if kind in STRUCT_CODES]
+    numeric = [fields[i] for i in indexes]
+    record = struct.Struct('<qB' + ''.join(STRUCT_CODES[kind] for _, kind in numeric))
+    columns = [['timestamp', '<i8'], ['valve', 'u1']]
+    columns += [[name, DTYPE_CODES[kind]] for name, kind in numeric]
+    return indexes, record, {'fields': columns, 'valve_states': VALVE_STATES}
+
+
+class BufferedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    TimedRotatingFileHandler that leaves flushing to commit(), so many lines
+    can be written per flush, and starts every new file with a header line.
+    """
+    # Line written at the top of each new file, if set.
+    header = None
+
+    def flush(self):
+        pass
+
+    def doRollover(self):
+        super().doRollover()
+        if self.header is not None:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.header + self.terminator)
+
+    def commit(self, fsync=False):
+        """
+        Flush written lines to the file, and to disk if fsync is set.
+        """
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.flush()
+                if fsync:
+                    os.fsync(self.stream.fileno())
+        finally:
+            self.release()
+
+
+class CSVStorage(object):
+    """
+    Writes samples as comma separated lines to a file that is rotated daily
+    by a TimedRotatingFileHandler.
+    """
+    def __init__(self, path, rotator=None):
+        """
+        Set up the data logger for the CSV file.
+        path : The path of the CSV file.
+        rotator : Function called with the current and rotated paths at
+                  rollover instead of renaming, see datafiles.Compressor.
+        """
+        self.path = path
+        self.data_logger = logging.Logger('data')
+        self.data_logger.setLevel(logging.INFO)
+        self.file_handler = BufferedRotatingFileHandler(path, when='D', interval=1)
+        self.file_handler.rotator = rotator
+        self.data_logger.addHandler(self.file_handler)
+        formatter = logging.Formatter('%(message)s')
+        self.file_handler.setFormatter(formatter)
+        self.file_handler.setLevel(logging.INFO)
+
+    def set_schema(self, fields):
+        """
+        Write the header line for the given fields, unless the column names
+        are unchanged.
+        fields : List of (name, kind) pairs, see serialdevices.MCPCSchema.
+        """
+        header = ','.join(['timestamp', 'valve'] + [name for name, _ in fields])
+        if header == self.file_handler.header:
+            return
+        self.file_handler.header = header
+        self.data_logger.info(header)
+
+    def write(self, timestamp_ns, valve, values):
+        """
+        Write one sample.
+        """
+        timestamp = datetime.datetime.fromtimestamp(timestamp_ns / 1e9).isoformat()
+        self.data_logger.info(','.join(map(str, [timestamp, valve] + values)))
+
+    def commit(self, fsync=False):
+        """
+        Flush written samples, and sync them to disk if fsync is set.
+        """
+        self.file_handler.commit(fsync)
+
+    def close(self):
+        self.file_handler.close()
+
+
+class BinaryStorage(object):
+    """
+    Writes samples as fixed-size little-endian records into one file per day,
+    named <base>.<YYYY-MM-DD>.rec. Each file starts with a header describing
+    the columns, followed by packed records of an int64 nanosecond timestamp,
+    a uint8 valve state and one int64 or float64 per numeric field. String
+    fields are left out.
+    """
+    def __init__(self, base):
+        """
+        Set up the backend.
+        base : Path prefix of the daily files, e.g. /mnt/data/data.
+        """
+        self.base = base
+        self.schema = None
+        # Positions of the numeric fields within each sample's values.
+        self.indexes = None
+        self.record = None
+        self.header = None
+        self.file = None
+        self.day = None
+
+    def set_schema(self, fields):
+        """
+        Set the fields of the samples to come. If the numeric fields change,
+        writing moves on to a new file so each file keeps a single schema.
+        fields : List of (name, kind) pairs, see serialdevices.MCPCSchema.
+        """
+        self.indexes, record, meta = record_layout(fields)
+        if meta == self.schema:
+            return
+        self.schema = meta
+        self.record = record
+        meta = json.dumps(meta).encode('utf-8')
+        self.header = HEADER.pack(MAGIC, len(meta)) + meta
+        self._close_file()
+
+    def _file_path(self, day, n):
+        if n == 0:
+            return '{}.{}.rec'.format(self.base, day)
+        return '{}.{}.{}.rec'.format(self.base, day, n)
+
+    def _open(self, day):
+        """
+        Open the file for the given day for appending, picking the first file
+        that is new or has a matching header.
+        """
+        n = 0
+        while True:
+            path = self._file_path(day, n)
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                self.file = open(path, 'wb')
+                self.file.write(self.header)
+                break
+            with open(path, 'rb') as f:
+                existing = f.read(len(self.header))
+            if existing == self.header:
+                self.file = open(path, 'ab')
+                # Drop a partial record left by an interrupted write.
+                excess = (os.path.getsize(path) - len(self.header)) % self.record.size
+                if excess:
+                    self.file.truncate(os.path.getsize(path) - excess)
+                break
+            n += 1
+        self.day = day
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.day = None
+
+    def write(self, timestamp_ns, valve, values):
+        """
+        Write one sample.
+        """
+        day = datetime.date.fromtimestamp(timestamp_ns / 1e9).isoformat()
+        if day != self.day:
+            self._close_file()
+            self._open(day)
+        self.file.write(self.record.pack(
+            timestamp_ns, encode_valve(valve), *[values[i] for i in self.indexes]))
+
+    def commit(self, fsync=False):
+        """
+        Flush written samples, and sync them to disk if fsync is set.
+        """
+        if self.file is not None:
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        self._close_file()
+
+
+def read_header(path):
+    """
+    Read the header of a binary record file.
+    Returns the schema dictionary and the byte offset of the first record.
+    """
+    with open(path, 'rb') as f:
+        magic, length = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('{!r} is not a record file'.format(path))
+        meta = json.loads(f.read(length).decode('utf-8'))
+    return meta, HEADER.size + length
+
+
+def read_records(path):
+    """
+    Memory-map a binary record file without parsing it.
+    Returns a NumPy structured array with one field per column. A partial
+    record at the end of the file (from an interrupted write) is left out.
+    """
+    import numpy as np
+
+    meta, offset = read_header(path)
+    dtype = np.dtype([tuple(f) for f in meta['fields']])
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def read_columns(path):
+    """
+    Memory-map a binary record file and return a dictionary of column name
+    to NumPy array. The arrays are views into the file.
+    """
+    records = read_records(path)
+    return {name: records[name] for name in records.dtype.names}
+
+
+class RingStorage(object):
+    """
+    Writes samples as the same fixed-size records as BinaryStorage into a
+    memory-mapped ring buffer file of a fixed number of records, overwriting
+    the oldest. The header holds the schema and a cursor counting the records
+    ever written, which is advanced after each record is in place, so readers
+    (see RingReader) need no locks. A file with the same schema and capacity
+    is carried on from its cursor, so the recent records survive a restart.
+    """
+    def __init__(self, path, capacity):
+        """
+        path : The ring buffer file, e.g. in /dev/shm to keep it off disk.
+        capacity : int number of records to keep.
+        """
+        self.path = path
+        self.capacity = capacity
+        self.indexes = None
+        self.record = None
+        self.header = None
+        self.cursor = 0
+        self.file = None
+        self.map = None
+
+    def set_schema(self, fields):
+        """
+        Set the fields of the samples to come. The ring is cleared if its
+        numeric fields change.
+        fields : List of (name, kind) pairs, see serialdevices.MCPCSchema.
+        """
+        self.indexes, self.record, meta = record_layout(fields)
+        meta = json.dumps(meta).encode('utf-8')
+        header = RING_HEADER.pack(RING_MAGIC, 0, self.capacity, len(meta)) + meta
+        if len(header) > RING_DATA_OFFSET:
+            raise ValueError('Ring buffer schema too large: {} bytes'.format(len(header)))
+        if header == self.header:
+            return
+        self.header = header
+        self.close()
+        self._open()
+
+    def _open(self):
+        """
+        Map the file, carrying on from its cursor if it holds the same schema
+        and capacity. Otherwise a fresh file replaces it, so readers still
+        mapping the old one are not cut short.
+        """
+        size = RING_DATA_OFFSET + self.capacity * self.record.size
+        try:
+            with open(self.path, 'rb') as f:
+                existing = f.read(len(self.header))
+            existing_size = os.path.getsize(self.path)
+        except OSError:
+            existing, existing_size = b'', 0
+        # The headers match but for the cursor.
+        cursor_end = RING_CURSOR_OFFSET + RING_CURSOR.size
+        same = (existing_size == size and len(existing) == len(self.header) and
+                existing[:RING_CURSOR_OFFSET] == self.header[:RING_CURSOR_OFFSET] and
+                existing[cursor_end:] == self.header[cursor_end:])
+        if not same:
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(self.header)
+                f.truncate(size)
+            os.replace(self.path + '.tmp', self.path)
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.cursor = RING_CURSOR.unpack_from(self.map, RING_CURSOR_OFFSET)[0]
+
+    def write(self, timestamp_ns, valve, values):
+        """
+        Write one sample over the oldest, then advance the cursor.
+        """
+        offset = RING_DATA_OFFSET + (self.cursor % self.capacity) * self.record.size
+        self.record.pack_into(self.map, offset, timestamp_ns, encode_valve(valve),
+                              *[values[i] for i in self.indexes])
+        self.cursor += 1
+        RING_CURSOR.pack_into(self.map, RING_CURSOR_OFFSET, self.cursor)
+
+    def commit(self, fsync=False):
+        """
+        Written samples are visible to readers straight away. Sync them to
+        disk if fsync is set.
+        """
+        if fsync and self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RingReader(object):
+    """
+    Reads the recent records of a ring buffer written by RingStorage, as
+    NumPy views into the shared mapping:
+
+        ring = RingReader('/dev/shm/data.ring')
+        for records in ring.views(3600):
+            print(records['concent'].mean())
+
+    Views are not copied, so records in them can be overwritten by the
+    writer while in use; check with valid() after use, or call latest() for
+    a consistent copy.
+    """
+    def __init__(self, path):
+        """
+        Map the ring buffer file read-only.
+        """
+        self.path = path
+        self._map()
+
+    def _map(self):
+        """
+        Map the file as it is now, picking up its schema.
+        """
+        import numpy as np
+
+        # An earlier mapping is left for the garbage collector, as views of
+        # it may still be in use.
+        with open(self.path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, self.capacity, length = RING_HEADER.unpack_from(self.map, 0)
+        if magic != RING_MAGIC:
+            raise ValueError('{!r} is not a ring buffer'.format(self.path))
+        self.meta = json.loads(bytes(self.map[RING_HEADER.size:RING_HEADER.size + length]).decode('utf-8'))
+        self.dtype = np.dtype([tuple(f) for f in self.meta['fields']])
+        self.records = np.frombuffer(self.map, dtype=self.dtype, count=self.capacity,
+                                     offset=RING_DATA_OFFSET)
+
+    def cursor(self):
+        """
+        Returns the number of records ever written.
+        """
+        return RING_CURSOR.unpack_from(self.map, RING_CURSOR_OFFSET)[0]
+
+    def views(self, count=None):
+        """
+        Returns the last count records (all held records by default), oldest
+        first, as a list of one or two structured array views, two when the
+        window wraps around the end of the file. Also returns the cursor
+        they were taken at, for valid(). If the writer has started a new
+        file, e.g. because the schema changed, it is mapped first.
+        """
+        if os.stat(self.path).st_ino != self.inode:
+            self._map()
+        cursor = self.cursor()
+        held = min(cursor, self.capacity)
+        count = held if count is None else min(count, held)
+        start, end = (cursor - count) % self.capacity, cursor % self.capacity
+        if count == 0:
+            return [], cursor
+        if start < end or end == 0:
+            return [self.records[start:end or self.capacity]], cursor
+        return [self.records[start:], self.records[:end]], cursor
+
+    def valid(self, cursor, count):
+        """
+        Returns how many of the newest count records taken at cursor have
+        not been overwritten since: all of them, unless the writer has moved
+        on by more than the free room in the ring.
+        """
+        # The record at the cursor may be being written over already.
+        overwritten = self.cursor() + 1 - cursor - (self.capacity - count)
+        return count - max(overwritten, 0)
+
+    def latest(self, count=None):
+        """
+        Returns a copy of the last count records as one structured array,
+        oldest first, leaving out any overwritten while copying.
+        """
+        import numpy as np
+
+        views, cursor = self.views(count)
+        copied = np.concatenate(views) if views else np.zeros(0, dtype=self.dtype)
+        valid = self.valid(cursor, len(copied))
+        return copied[len(copied) - valid:]
+
+    def close(self):
+        self.records = None
+        self.map.close()
+        self.map = None
+
+
+class ChangeLogStorage(object):
+    """
+    Keeps the last record in memory and appends it to a JSON lines file only
+    when its values change, for slowly changing data such as device settings.
+    The last line of an existing file is read back on start, so restarts do
+    not repeat unchanged records.
+    """
+    def __init__(self, path):
+        """
+        path : The JSON lines file to append changed records to.
+        """
+        self.path = path
+        self.fields = []
+        # Field names and values of the last record written.
+        self.last = None
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.last = json.loads(line)['values']
+                    except (ValueError, KeyError):
+                        pass
+        self.file = open(path, 'a')
+
+    def set_schema(self, fields):
+        """
+        fields : List of (name, kind) pairs, see serialdevices.MCPCSchema.
+        """
+        self.fields = [name for name, _ in fields]
+
+    def write(self, timestamp_ns, valve, values):
+        """
+        Write the record if it differs from the last one.
+        """
+        record = dict(zip(self.fields, values))
+        if record == self.last:
+            return
+        self.last = record
+        timestamp = datetime.datetime.fromtimestamp(timestamp_ns / 1e9).isoformat()
+        self.file.write(json.dumps({'timestamp': timestamp, 'values': record}) + '\n')
+
+    def commit(self, fsync=False):
+        """
+        Flush written records, and sync them to disk if fsync is set.
+        """
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def make_diagnostic_storages(cfg, rotator=None):
+    """
+    Create the backends for the slower MCPC commands: full 'all' responses
+    go to <base>.all.csv, and 'settings' responses to
+    <base>.settings.jsonl whenever they change.
+    rotator : Rotator for the CSV file, see CSVStorage.
+    Returns a dictionary of command to list of backends.
+    """
+    base = os.path.splitext(cfg.save_file)[0]
+    return {
+        'all': [CSVStorage(all_file(cfg.save_file), rotator=rotator)],
+        'settings': [ChangeLogStorage(base + '.settings.jsonl')],
+    }
+
+
+def make_storages(cfg, rotator=None):
+    """
+    Create the storage backends listed in the configuration's comma separated
+    storage value: 'csv', 'binary', 'ring' (the last ring_records records in
+    ring_file, default <base>.ring) and/or 'summary' (per valve phase
+    statistics in <base>.summary.jsonl).
+    rotator : Rotator for the CSV file, see CSVStorage.
+    """
+    storages = []
+    for name in cfg.storage.split(','):
+        name = name.strip()
+        if name == 'csv':
+            storages.append(CSVStorage(cfg.save_file, rotator=rotator))
+        elif name == 'binary':
+            storages.append(BinaryStorage(os.path.splitext(cfg.save_file)[0]))
+        elif name == 'ring':
+            path = cfg.ring_file or os.path.splitext(cfg.save_file)[0] + '.ring'
+            storages.append(RingStorage(path, cfg.ring_records))
+        elif name == 'summary':
+            quantiles = [float(q) for q in cfg.quantiles.split(',')]
+            storages.append(PhaseSummaryStorage(os.path.splitext(cfg.save_file)[0] + '.summary.jsonl',
+                                                settle_time=cfg.settle_time, quantiles=quantiles))
+        elif name:
+            raise ValueError('Unknown storage backend {!r}'.format(name))
+    return storages
@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+"""
+Hardware-free benchmarks for serialdevices.py and the logging pipeline, run
+against the simulators in simulators.py. The simulators run in a separate
+process, so the CPU figures only count the code under test.
+
+Run from this folder:
+
+python3 benchmark.py --duration 5 --latency 0.02 --baud 38400
+
+Pass --json FILE to save the results, e.g. to compare before and after a
+change.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from simulators import BS1010Simulator, MCPCSimulator
+# Grab the dependency from the directory above.
+sys.path.append(os.path.realpath('..'))
+from serialdevices import BS1010, MCPC, MCPCSchema, ThreeWayValve
+from pipeline import Pipeline
+from storage import BinaryStorage, CSVStorage
+
+
+def _serve(simulator_class, kwargs, cnxn):
+    simulator = simulator_class(**kwargs)
+    simulator.start()
+    cnxn.send(simulator.port)
+    # Serve until the benchmark terminates this process.
+    simulator.join()
+
+
+def start_simulator(simulator_class, **kwargs):
+    """
+    Start a simulator in its own process.
+    Returns the process and the port to connect to.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(simulator_class, kwargs, child), daemon=True)
+    process.start()
+    return process, parent.recv()
+
+
+def cpu_time():
+    """
+    Returns the CPU seconds (user and system) used by this process so far.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def summarize(latencies):
+    """
+    Returns a dictionary of latency statistics in milliseconds.
+    """
+    latencies = sorted(latencies)
+    return {
+        'mean_ms': 1000 * statistics.mean(latencies),
+        'p50_ms': 1000 * latencies[len(latencies) // 2],
+        'p99_ms': 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        'max_ms': 1000 * latencies[-1],
+    }
+
+
+def bench_mcpc_sampling(args):
+    """
+    Read from the MCPC back to back for the benchmark duration.
+    """
+    process, port = start_simulator(MCPCSimulator, latency=args.latency, baudrate=args.baud)
+    mcpc = MCPC()
+    mcpc.connect(port=port, baudrate=args.baud or 38400)
+    latencies = []
+    start, cpu_start = time.monotonic(), cpu_time()
+    while time.monotonic() - start < args.duration:
+        sent = time.monotonic()
+        mcpc.get_reading()
+        latencies.append(time.monotonic() - sent)
+    elapsed, cpu = time.monotonic() - start, cpu_time() - cpu_start
+    mcpc.close()
+    process.terminate()
+    result = {'samples_per_sec': len(latencies) / elapsed, 'cpu_percent': 100 * cpu / elapsed}
+    result.update(summarize(latencies))
+    return result
+
+
+def bench_valve_round_trip(args):
+    """
+    Query the valve position back to back for the benchmark duration.
+    """
+    process, port = start_simulator(BS1010Simulator, latency=args.latency, baudrate=args.baud)
+    valve = BS1010()
+    valve.connect(port=port, baudrate=args.baud or 9600, reset=False)
+    latencies = []
+    start, cpu_start = time.monotonic(), cpu_time()
+    while time.monotonic() - start < args.duration:
+        sent = time.monotonic()
+        valve.get_pos()
+        latencies.append(time.monotonic() - sent)
+    elapsed, cpu = time.monotonic() - start, cpu_time() - cpu_start
+    valve.close()
+    process.terminate()
+    result = {'round_trips_per_sec': len(latencies) / elapsed, 'cpu_percent': 100 * cpu / elapsed}
+    result.update(summarize(latencies))
+    return result
+
+
+def bench_valve_homing(args):
+    """
+    Connect to and home the valve, then switch it between positions.
+    """
+    process, port = start_simulator(BS1010Simulator, latency=args.latency, baudrate=args.baud)
+    valve = ThreeWayValve()
+    start, cpu_start = time.monotonic(), cpu_time()
+    valve.connect(port=port, baudrate=args.baud or 9600)
+    homing = time.monotonic() - start
+    switch_start = time.monotonic()
+    valve.open_b()
+    valve.wait_for_idle()
+    switching = time.monotonic() - switch_start
+    elapsed, cpu = time.monotonic() - start, cpu_time() - cpu_start
+    valve.close()
+    process.terminate()
+    return {'homing_s': homing, 'switch_s': switching, 'cpu_percent': 100 * cpu / elapsed}
+
+
+def bench_pipeline(args):
+    """
+    Push canned MCPC responses through the parse and storage pipeline.
+    """
+    raw = b''.join('{}={:<8}\r'.format(name, i * 1.5).encode('ascii')
+                   for i, name in enumerate(MCPCSimulator.read_fields)) + b'\r'
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'data')
+        storages = [CSVStorage(base + '.csv'), BinaryStorage(base)]
+        pipeline = Pipeline(MCPCSchema(), storages, queue_size=1 << 16)
+        pipeline.start()
+        count = 0
+        start, cpu_start = time.monotonic(), cpu_time()
+        while time.monotonic() - start < args.duration / 2:
+            for _ in range(1000):
+                pipeline.submit(time.time_ns(), 'a', raw)
+            count += 1000
+        pipeline.stop()
+        elapsed, cpu = time.monotonic() - start, cpu_time() - cpu_start
+        stats = pipeline.get_stats()
+    written = stats['writer']['processed']
+    return {
+        'records_per_sec': written / elapsed,
+        'dropped': stats['parse']['dropped'],
+        'cpu_percent': 100 * cpu / elapsed,
+        'submitted': count,
+    }
+
+
+BENCHMARKS = [
+    ('mcpc_sampling', bench_mcpc_sampling),
+    ('valve_round_trip', bench_valve_round_trip),
+    ('valve_homing', bench_valve_homing),
+    ('pipeline', bench_pipeline),
+]
+
+
+def main():
+    """
+    Run the selected benchmarks and print their results.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', default=[name for name, _ in BENCHMARKS],
+                        help='Benchmarks to run, defaults to all.')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run each benchmark for.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated device response latency.')
+    parser.add_argument('--baud', type=int, default=None, help='Simulated line speed, unpaced by default.')
+    parser.add_argument('--json', type=argparse.FileType('w'), default=None, help='File to save results to.')
+    args = parser.parse_args()
+
+    results = {}
+    for name, bench in BENCHMARKS:
+        if name not in args.benchmarks:
+            continue
+        results[name] = bench(args)
+        print('{}: {}'.format(name, ', '.join(
+            '{}={:.3f}'.format(k, v) for k, v in results[name].items())))
+    if args.json is not None:
+        json.dump(results, args.json, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,7 @@ VALUES = [
     ('VALVE_PORT', str, None),
     ('VALVE_BAUD', int, 9600),
     ('VALVE_PERIOD', int, 10),
-    ('SAMPLING_PERIOD', int, 1),
+    ('SAMPLING_PERIOD', float, 1),
     ('SAVE_FILE', str, 'data.csv'),
 ]
 
@@ -0,0 +1,58 @@
+#! /usr/bin/env python3
+"""
+Check that datareader's sidecar indexes survive the daily rollover: a CSV
+file is indexed, rotated away by the compressor's rotator, and replaced by a
+larger file for the new day, which must then be queried correctly. This test
+does not need any devices or environment variables, it works in a temporary
+directory.
+"""
+import datetime
+import os
+import sys
+import tempfile
+
+# Grab the dependency from the directory above.
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+from datafiles import Compressor
+from datareader import parse_time, query
+
+
+def write_day(path, day, rows):
+    """
+    Write one row a second from midnight of day.
+    """
+    start = datetime.datetime.fromisoformat(day)
+    with open(path, 'w') as f:
+        f.write('timestamp,valve,concent\n')
+        for i in range(rows):
+            timestamp = (start + datetime.timedelta(seconds=i)).isoformat()
+            f.write('{},a,{}\n'.format(timestamp, i))
+
+
+def count_rows(save_file, start, end):
+    return sum(len(chunk['timestamp']) for chunk in query([save_file], parse_time(start), parse_time(end)))
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    save_file = os.path.join(directory, 'data.csv')
+    compressor = Compressor(save_file, compression=None)
+
+    write_day(save_file, '2020-11-01', 3000)
+    assert count_rows(save_file, '2020-11-01T00:10', '2020-11-01T00:20') == 600
+    compressor.rotator(save_file, save_file + '.2020-11-01')
+
+    write_day(save_file, '2020-11-02', 4000)
+    rows = count_rows(save_file, '2020-11-02T00:10', '2020-11-02T00:20')
+    assert rows == 600, 'Expected 600 rows after rollover, got {}'.format(rows)
+    rows = count_rows(save_file + '.2020-11-01', '2020-11-01T00:10', '2020-11-01T00:20')
+    assert rows == 600, 'Expected 600 rows from the rotated file, got {}'.format(rows)
+
+    # A stale sidecar left next to the new file is rebuilt, not extended.
+    os.rename(save_file + '.2020-11-01.idx', save_file + '.idx')
+    rows = count_rows(save_file, '2020-11-02T00:10', '2020-11-02T00:20')
+    assert rows == 600, 'Expected 600 rows with a stale index, got {}'.format(rows)
+    print('Rotation test passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+#! /usr/bin/env python3
+"""
+Simulated MCPC and BS1010 devices on pseudo-terminals, for running and
+benchmarking the code in serialdevices.py without the sensor box.
+
+Each simulator opens a pty pair and answers on the master side, so code under
+test connects to simulator.port like any other serial port:
+
+    sim = MCPCSimulator(latency=0.05)
+    sim.start()
+    mcpc = MCPC()
+    mcpc.connect(port=sim.port, baudrate=38400)
+
+Run this file directly to start both simulators and print their ports, which
+is handy for trying the top-level scripts by hand.
+"""
+import argparse
+import math
+import os
+import queue
+import random
+import select
+import threading
+import time
+import tty
+
+
+class PtySimulator(threading.Thread):
+    """
+    Base class for a device answering on the master side of a pty. Subclasses
+    implement handle(), which is called with every chunk of received bytes.
+    """
+    def __init__(self, latency=0.0, baudrate=None):
+        """
+        latency : float number of seconds between a command and its response.
+                  Like the delay of a USB serial adapter, it applies to each
+                  response without holding up the commands after it.
+        baudrate : If set, responses are paced to this many bits per second
+                   (10 bits per byte) like a real serial line.
+        """
+        super().__init__(daemon=True)
+        self.latency = latency
+        self.baudrate = baudrate
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        # The path code under test should connect to.
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        # Responses waiting to be sent, with the monotonic time they are due.
+        self.outgoing = queue.Queue()
+
+    def stop(self):
+        """
+        Stop answering and close the pty.
+        """
+        self.running = False
+        self.join()
+        self.outgoing.put(None)
+        self.sender.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        self.sender = threading.Thread(target=self._send_responses, daemon=True)
+        self.sender.start()
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if readable:
+                self.handle(os.read(self.master, 1024))
+
+    def respond(self, data: bytes):
+        """
+        Send a response after the configured latency, paced to the baud rate.
+        """
+        self.outgoing.put((time.monotonic() + self.latency, data))
+
+    def _send_responses(self):
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                return
+            due, data = item
+            time.sleep(max(due - time.monotonic(), 0))
+            self._write(data)
+
+    def _write(self, data: bytes):
+        if not self.baudrate:
+            os.write(self.master, data)
+            return
+        # Send in small chunks so the first bytes arrive before the last
+        # ones, as they would over a real line.
+        chunk = 16
+        for i in range(0, len(data), chunk):
+            os.write(self.master, data[i:i + chunk])
+            time.sleep(len(data[i:i + chunk]) * 10 / self.baudrate)
+
+    def handle(self, data: bytes):
+        raise NotImplementedError
+
+
+class MCPCSimulator(PtySimulator):
+    """
+    Simulated MCPC answering the read, all and settings commands with records
+    of name=value lines ending in a blank line.
+    """
+    read_fields = [
+        'concent', 'rawconc', 'cnt_sec', 'condtmp', 'satttmp', 'satbtmp',
+        'optctmp', 'inlttmp', 'smpflow', 'satflow', 'pressur', 'condpwr',
+        'sattpwr', 'satbpwr', 'optcpwr', 'satfpwr', 'exhfpwr', 'fillcnt',
+        'err_num',
+    ]
+    settings = [
+        ('serialn', 'MCPC0123'), ('fw_ver', '1.5.2'), ('smpflow', '0.36'),
+        ('satttmp', '35.0'), ('condtmp', '10.0'), ('period', '1'),
+    ]
+
+    def __init__(self, latency=0.0, baudrate=None):
+        super().__init__(latency=latency, baudrate=baudrate)
+        self.line = b''
+        self.start_time = time.monotonic()
+
+    def _record(self, pairs):
+        return b''.join('{}={:<8}\r'.format(k, v).encode('ascii') for k, v in pairs) + b'\r'
+
+    def _reading(self):
+        t = time.monotonic() - self.start_time
+        concent = 1500 + 500 * math.sin(t / 60) + random.gauss(0, 20)
+        values = {
+            'concent': '{:.2f}'.format(concent),
+            'rawconc': '{:.2f}'.format(concent * 1.02),
+            'cnt_sec': str(int(concent * 6)),
+            'condtmp': '{:.1f}'.format(10 + random.gauss(0, 0.05)),
+            'satttmp': '{:.1f}'.format(35 + random.gauss(0, 0.05)),
+            'satbtmp': '{:.1f}'.format(35 + random.gauss(0, 0.05)),
+            'optctmp': '{:.1f}'.format(40 + random.gauss(0, 0.05)),
+            'inlttmp': '{:.1f}'.format(22 + random.gauss(0, 0.05)),
+            'smpflow': '{:.3f}'.format(0.36 + random.gauss(0, 0.001)),
+            'satflow': '{:.3f}'.format(0.30 + random.gauss(0, 0.001)),
+            'pressur': '{:.1f}'.format(1013 + random.gauss(0, 0.3)),
+        }
+        pairs = []
+        for name in self.read_fields:
+            pairs.append((name, values.get(name, str(random.randint(0, 100)) if name.endswith('pwr') else '0')))
+        return pairs
+
+    def handle(self, data):
+        self.line += data
+        while True:
+            # Commands end in \r\n, but accept either on its own too.
+            ends = [i for i in (self.line.find(b'\r'), self.line.find(b'\n')) if i >= 0]
+            if not ends:
+                return
+            end = min(ends)
+            cmd, self.line = self.line[:end].strip(), self.line[end + 1:]
+            if cmd == b'read':
+                self.respond(self._record(self._reading()))
+            elif cmd == b'all':
+                self.respond(self._record(self._reading() + self.settings))
+            elif cmd == b'settings':
+                self.respond(self._record(self.settings))
+            elif cmd:
+                self.respond(b'unknown command\r\r')
+
+
+class BS1010Simulator(PtySimulator):
+    """
+    Simulated BS1010 driving the X axis of a valve between two limit
+    switches. Commands are an optional signed number followed by a command
+    character, and every command except X is acknowledged with '*'.
+    """
+    # Physical travel in steps between the X- and X+ limit switches.
+    travel = 2200
+    # Run speed after a reset, in steps per second.
+    default_speed = 800
+
+    def __init__(self, latency=0.0, baudrate=None, start_pos=500):
+        """
+        start_pos : Physical position of the motor, in steps above the X-
+                    limit switch, when the simulator starts.
+        """
+        super().__init__(latency=latency, baudrate=baudrate)
+        self.arg = b''
+        self.physical = float(start_pos)
+        # Board position minus physical position, changed by '='.
+        self.offset = 0
+        self.target = self.physical
+        self.speed = self.default_speed
+        # Just powered on, which latches a reset.
+        self.latches = 16
+        self.last_update = time.monotonic()
+
+    def _update(self):
+        """
+        Advance the motor towards its target, stopping at the limit switches.
+        """
+        now = time.monotonic()
+        step = self.speed * (now - self.last_update)
+        self.last_update = now
+        if self.target > self.physical:
+            self.physical = min(self.target, self.physical + step)
+        else:
+            self.physical = max(self.target, self.physical - step)
+        # Driving into a limit switch stops the motor and latches it.
+        if self.physical <= 0 and self.target < 0:
+            self.physical = self.target = 0.0
+            self.latches |= 4
+        elif self.physical >= self.travel and self.target > self.travel:
+            self.physical = self.target = float(self.travel)
+            self.latches |= 8
+
+    def _time_to_idle(self):
+        """
+        Returns the seconds until the motor stops moving.
+        """
+        limit = min(max(self.target, 0), self.travel)
+        return abs(limit - self.physical) / self.speed
+
+    def position(self):
+        return int(round(self.physical)) + self.offset
+
+    def handle(self, data):
+        for c in data.decode('ascii', errors='replace'):
+            if c.isdigit() or c == '-':
+                self.arg += c.encode('ascii')
+                continue
+            arg = int(self.arg) if self.arg not in (b'', b'-') else None
+            self.arg = b''
+            self._update()
+            if c == 'G':
+                self.target = arg - self.offset
+                self.respond(b'*')
+            elif c == '=':
+                self.offset = arg - int(round(self.physical))
+                self.respond(b'*')
+            elif c == '?':
+                # Replies so that BS1010.get_pos reads the X position.
+                self.respond('{},0,{}*'.format(arg, self.position()).encode('ascii'))
+            elif c == 'L':
+                self.respond('{},{}*'.format(0 if arg is None else arg, self.latches).encode('ascii'))
+                self.latches = 0
+            elif c == 'I':
+                time.sleep(self._time_to_idle())
+                self._update()
+                self.respond(b'*')
+            elif c == 'R':
+                self.speed = arg
+                self.respond(b'*')
+            elif c == '!':
+                self.target = self.physical
+                self.offset = -int(round(self.physical))
+                self.speed = self.default_speed
+                self.latches = 16
+                self.respond(b'*')
+            elif c == 'X':
+                # Axis selection is not acknowledged.
+                pass
+            elif c.strip():
+                self.respond(b'*')
+
+
+def main():
+    """
+    Start a simulated MCPC and valve, and print their ports.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--baud', type=int, default=None)
+    args = parser.parse_args()
+    mcpc = MCPCSimulator(latency=args.latency, baudrate=args.baud)
+    valve = BS1010Simulator(latency=args.latency, baudrate=args.baud)
+    mcpc.start()
+    valve.start()
+    print('export MCPC_PORT={}'.format(mcpc.port))
+    print('export VALVE_PORT={}'.format(valve.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
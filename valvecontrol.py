@@ -0,0 +1,269 @@
+"""
+Valve control that runs alongside data logging. Moves are carried out on a
+worker thread so slow acknowledgements and motion stalls never hold up the
+sampling loop. Moves scheduled for a phase boundary start early by the
+measured transit time, so the valve arrives at the boundary. The worker can
+follow a valve sequence (see scheduling.SequenceSchedule) by itself,
+sleeping until each step is due.
+"""
+import queue
+import threading
+import time
+
+import serial
+
+import metrics
+
+# Valve state published while the valve is moving between positions, or when
+# a move failed and the position is unknown.
+TRANSIT = 'transit'
+
+
+def state_label(state):
+    """
+    Returns the short label used for a valve state in data records, e.g.
+    'a' for 'a_open'.
+    """
+    if state is None:
+        return None
+    if state.endswith('_open'):
+        return state[:-len('_open')]
+    return state
+
+
+class ValveWorker(threading.Thread):
+    """
+    Worker thread that owns a ThreeWayValve and moves it between the named
+    positions in ThreeWayValve.positions on request. The current valve state
+    is published for other threads through get_state().
+
+    The transit time of every move between two named positions is measured
+    and smoothed, and moves with a deadline start that long before it so the
+    valve arrives on time.
+    """
+    def __init__(self, valve, idle_timeout=5):
+        """
+        Set up the worker for a connected (and zeroed) valve.
+        valve : The ThreeWayValve to control.
+        idle_timeout : int number of seconds to wait for a move to finish.
+        """
+        super().__init__(name='valve', daemon=True)
+        self.valve = valve
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics.REGISTRY
+        # (named position, arrival deadline, speed) requests waiting to be
+        # carried out, None stops the worker.
+        self.requests = queue.Queue()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        # The named position the valve is at, TRANSIT while moving, or None
+        # before the first move.
+        self.state = None
+        # Functions called with the new state whenever it changes.
+        self.listeners = []
+        # SequenceSchedule followed in place of requests, if any, and the
+        # tick of the step under way or next.
+        self.schedule = None
+        self.sequence_tick = 0
+        # Sequence steps skipped because the next one had already started.
+        self.skipped = 0
+        # The named position the valve was last seen at, None if unknown.
+        names = {value: name for name, value in valve.positions.items()}
+        self.position = names.get(valve.xpos)
+        # Smoothed transit time in seconds, keyed by (from, to) named
+        # positions.
+        self.transit = {}
+        self.moves = 0
+        # Moves that failed with an error, e.g. a timeout or a failed check
+        # while re-zeroing.
+        self.failures = 0
+        # Arrival time minus deadline, in seconds, of moves with a deadline.
+        self.switches = 0
+        self.switch_latency = None
+        self.switch_latency_sum = 0.0
+        self.switch_latency_min = None
+        self.switch_latency_max = None
+
+    def get_state(self):
+        """
+        Returns the current valve state.
+        """
+        with self.lock:
+            return self.state
+
+    def _set_state(self, state):
+        with self.lock:
+            self.state = state
+        for listener in self.listeners:
+            listener(state)
+
+    def add_listener(self, listener):
+        """
+        Call listener with the new state, on the worker thread, whenever the
+        state changes. It should return quickly.
+        """
+        self.listeners.append(listener)
+
+    def request(self, pos: str, arrive_by=None, speed=None):
+        """
+        Ask the worker to move to a named position. Returns immediately.
+        arrive_by : Monotonic time the valve should be at the position by.
+                    The move starts that long before it as the move is
+                    expected to take. None to move as soon as possible.
+        speed : int run speed to move at, None for the valve's default.
+        """
+        self.requests.put((pos, arrive_by, speed))
+
+    def follow(self, schedule):
+        """
+        Carry out the steps of a scheduling.SequenceSchedule from its next
+        tick on, instead of requests. Each move starts early by its expected
+        transit time, so the valve arrives at the step's deadline. Call
+        before starting the worker.
+        """
+        self.schedule = schedule
+        self.sequence_tick = schedule.tick
+
+    def upcoming(self, count=1):
+        """
+        Returns the next count steps of the followed sequence, from the one
+        under way or next, as (deadline, step) pairs. Empty when not
+        following a sequence.
+        """
+        if self.schedule is None:
+            return []
+        with self.lock:
+            tick = self.sequence_tick
+        return [(self.schedule.deadline(t), self.schedule.step(t)) for t in range(tick, tick + count)]
+
+    def stop(self):
+        """
+        Stop the worker once the move under way is done. Requested moves not
+        yet started are dropped.
+        """
+        self.stopped.set()
+        self.requests.put(None)
+
+    def lead_time(self, source, target):
+        """
+        Returns how many seconds before its deadline a move from source to
+        target starts: the smoothed transit time, or 0 before any such move
+        was measured.
+        """
+        with self.lock:
+            return self.transit.get((source, target), 0.0)
+
+    def _observe_transit(self, source, target, seconds):
+        with self.lock:
+            estimate = self.transit.get((source, target), seconds)
+            self.transit[(source, target)] = estimate + (seconds - estimate) / 8
+        self.metrics.observe('valve_transit_seconds', seconds, move='{}:{}'.format(source, target))
+
+    def _observe_switch(self, latency):
+        self.switches += 1
+        self.switch_latency = latency
+        self.switch_latency_sum += latency
+        if self.switch_latency_min is None:
+            self.switch_latency_min = self.switch_latency_max = latency
+        self.switch_latency_min = min(self.switch_latency_min, latency)
+        self.switch_latency_max = max(self.switch_latency_max, latency)
+
+    def run(self):
+        if self.schedule is not None:
+            self._follow_schedule()
+            return
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            pos, arrive_by, speed = item
+            if arrive_by is not None:
+                start = arrive_by - self.lead_time(self.position, pos)
+                if self.stopped.wait(max(start - time.monotonic(), 0)):
+                    return
+            self._move(pos, arrive_by, speed)
+
+    def _follow_schedule(self):
+        schedule = self.schedule
+        tick = self.sequence_tick
+        while True:
+            # Skip to the step under way if its successors were missed.
+            current = schedule.tick_at(time.monotonic())
+            if current > tick:
+                self.skipped += current - tick
+                tick = current
+            with self.lock:
+                self.sequence_tick = tick
+            deadline = schedule.deadline(tick)
+            pos, _, speed = schedule.step(tick)
+            start = deadline - self.lead_time(self.position, pos)
+            if self.stopped.wait(max(start - time.monotonic(), 0)):
+                return
+            self._move(pos, deadline, speed)
+            tick += 1
+
+    def _move(self, pos, arrive_by, speed=None):
+        """
+        Move to a named position, measuring the transit time and, if the move
+        has a deadline, how late it arrived.
+        """
+        source, self.position = self.position, None
+        self._set_state(TRANSIT)
+        start = time.monotonic()
+        if speed is None:
+            speed = self.valve.speed
+        try:
+            transit, reached = self.valve.move_to(pos, timeout=self.idle_timeout, speed=speed)
+        except (serial.SerialException, AssertionError, ValueError, IndexError) as e:
+            # Leave the state in transit, the position is unknown until
+            # the next successful move. The worker carries on with the next
+            # request or step.
+            self.failures += 1
+            print('Valve failed to move to {!r}: {!r}'.format(pos, e))
+            return
+        self.moves += 1
+        if reached != self.valve.positions[pos]:
+            print('Valve stopped at {} on its way to {!r}.'.format(reached, pos))
+            return
+        self.position = pos
+        self._set_state(pos)
+        if source is not None:
+            self._observe_transit(source, pos, transit)
+        if arrive_by is not None:
+            self._observe_switch(start + transit - arrive_by)
+
+    def get_stats(self):
+        """
+        Returns a dictionary of move, failed move, switch and skipped step
+        counts, the last, mean, minimum and maximum switch latency (arrival
+        time minus deadline, in seconds), and the smoothed transit time of
+        each measured move.
+        """
+        stats = {
+            'moves': self.moves,
+            'failures': self.failures,
+            'switches': self.switches,
+            'skipped': self.skipped,
+            'switch_latency_last': self.switch_latency,
+            'switch_latency_mean': self.switch_latency_sum / self.switches if self.switches else None,
+            'switch_latency_min': self.switch_latency_min,
+            'switch_latency_max': self.switch_latency_max,
+        }
+        with self.lock:
+            transit = sorted(self.transit.items())
+        for (source, target), estimate in transit:
+            stats['transit_{}_{}'.format(state_label(source), state_label(target))] = estimate
+        return stats
+
+    def format_stats(self):
+        """
+        Returns the statistics as a one line human readable summary.
+        """
+        stats = self.get_stats()
+        if not self.switches:
+            return 'moves={moves} failures={failures} switches=0 skipped={skipped}'.format(**stats)
+        transit = ' '.join('{}={:.3f}s'.format(k, v) for k, v in stats.items() if k.startswith('transit_'))
+        return ('moves={moves} failures={failures} switches={switches} skipped={skipped} '
+                'switch latency last={switch_latency_last:.3f}s '
+                'mean={switch_latency_mean:.3f}s min={switch_latency_min:.3f}s '
+                'max={switch_latency_max:.3f}s '.format(**stats) + transit).rstrip()
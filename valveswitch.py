@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 """Switch a three-way valve between postions."""
 import argparse
-import time
 
+from scheduling import SequenceSchedule, parse_sequence
 from serialdevices import ThreeWayValve
 
 
@@ -10,27 +10,31 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('valve_port')
     parser.add_argument('--valve-baud', type=int, required=False, default=9600)
-    parser.add_argument('period', type=int)
+    parser.add_argument('period', type=float, nargs='?', default=None,
+                        help='Seconds for a full a and b cycle.')
+    parser.add_argument('--sequence', required=False, default=None,
+                        help='Repeating position:seconds[@speed] steps instead, '
+                             'e.g. a_open:300,both:30,b_open:300@1600.')
     args = parser.parse_args()
+    if args.sequence is None and args.period is None:
+        parser.error('Either a period or --sequence is required.')
+
+    steps = parse_sequence(args.sequence or 'a_open:{0},b_open:{0}'.format(args.period / 2))
+    steps = [(ThreeWayValve.position_name(pos), seconds, speed) for pos, seconds, speed in steps]
 
     valve = ThreeWayValve()
     valve.connect(port=args.valve_port, baudrate=args.valve_baud)
 
-    period = args.period
-    is_a = True  # start with a valve
-    start = time.time()
-    valve.open_a()
-    print('a')
+    # Switch at fixed offsets from the start, sleeping until each step, so
+    # the time spent moving does not accumulate.
+    schedule = SequenceSchedule(steps)
     while True:
-        if time.time() - start > period/2:
-            is_a = not is_a
-            which_one = 'a' if is_a else 'b'
-            start = time.time()
-            valve.open_a() if which_one == 'a' else valve.open_b()
-            print(which_one)
-            # valve.wait_for_idle()
-            # print('done')
-        time.sleep(0.1)
+        pos, _, speed = schedule.step(schedule.wait())
+        speed = valve.speed if speed is None else speed
+        if speed != valve.runspeed:
+            valve.set_runspeed(speed)
+        valve.goto_pos(pos)
+        print(pos)
 
 
 if __name__ == '__main__':